@@ -0,0 +1,7 @@
+"""Load generation and benchmarks for bot.py.
+
+Builds the real Application from ``bot.build_application`` against a local
+stub of the Bot API and replays synthetic update streams through it::
+
+    python -m bench --users 100000 --updates 20000 --latency 0.05
+"""
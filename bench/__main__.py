@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+from telegram import Update
+
+from bench import updates
+from bench.stub_api import StubBotAPI
+from models import UserRecord, dump_users
+
+SEED_ID_BASE = 10_000_000
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark bot.py handlers")
+    parser.add_argument("--users", type=int, default=10_000, help="number of seeded users")
+    parser.add_argument("--updates", type=int, default=5_000, help="updates per scenario")
+    parser.add_argument("--concurrency", type=int, default=64, help="updates processed at once")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub Bot API latency in seconds")
+    parser.add_argument("--backend", choices=["journal", "sqlite"], default="journal")
+    parser.add_argument("--scenarios", default="start,daily,leaderboard,broadcast",
+                        help="comma-separated subset of start,daily,leaderboard,broadcast")
+    parser.add_argument("--broadcast-rate", type=float, default=1000.0,
+                        help="global send rate for the broadcast scenario (Telegram allows ~30/s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    return parser.parse_args(argv)
+
+
+def seed_users(path, count, rng):
+    """Write a users.json snapshot with ``count`` users and a skewed referral distribution."""
+    users = {}
+    for i in range(count):
+        referrals = int(rng.paretovariate(1.5)) - 1
+        users[SEED_ID_BASE + i] = UserRecord(
+            points=referrals * 10 + rng.randrange(0, 50),
+            referrals=referrals,
+            name=f"User{SEED_ID_BASE + i}",
+        )
+    with open(path, "w") as f:
+        json.dump(dump_users(users), f, separators=(",", ":"))
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        # ru_maxrss is the peak, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class WriteTimer:
+    """Wraps store write methods and accumulates the time spent in them."""
+
+    def __init__(self, store, names):
+        self.calls = 0
+        self.seconds = 0.0
+        for name in names:
+            if hasattr(store, name):
+                setattr(store, name, self._wrap(getattr(store, name)))
+
+    def _wrap(self, method):
+        if asyncio.iscoroutinefunction(method):
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    self._add(started)
+        else:
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    self._add(started)
+        return timed
+
+    def _add(self, started):
+        self.calls += 1
+        self.seconds += time.perf_counter() - started
+
+    def reset(self):
+        self.calls = 0
+        self.seconds = 0.0
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def replay(app, update_dicts, concurrency):
+    """Feed updates through app.process_update and return per-update latencies in seconds."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(data):
+        update = Update.de_json(data, app.bot)
+        async with semaphore:
+            started = time.perf_counter()
+            await app.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(data) for data in update_dicts))
+    return latencies
+
+
+def build_stream(name, args, rng, next_new_id):
+    seeded = [SEED_ID_BASE + rng.randrange(args.users) for _ in range(args.updates)]
+    if name == "start":
+        return [updates.start_with_referral(next_new_id + i, seeded[i]) for i in range(args.updates)]
+    if name == "daily":
+        return [updates.daily_reward(user_id) for user_id in seeded]
+    if name == "leaderboard":
+        return [updates.leaderboard(user_id) for user_id in seeded]
+    raise ValueError(f"Unknown scenario: {name}")
+
+
+async def run(args, bot, stub):
+    rng = random.Random(args.seed)
+    app = bot.build_application(request=stub)
+    results = []
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    writes = WriteTimer(bot.store, ["put", "put_many", "flush"])
+    try:
+        next_new_id = SEED_ID_BASE + args.users
+        for name in args.scenarios.split(","):
+            stub.calls.clear()
+            writes.reset()
+            started = time.perf_counter()
+
+            if name == "broadcast":
+                await app.process_update(Update.de_json(updates.broadcast(bot.config.primary_admin), app.bot))
+                if bot.broadcaster._task is not None:
+                    await bot.broadcaster._task
+                latencies = []
+                processed = stub.calls["sendMessage"]
+            else:
+                stream = build_stream(name, args, rng, next_new_id)
+                next_new_id += len(stream)
+                latencies = await replay(app, stream, args.concurrency)
+                processed = len(latencies)
+
+            elapsed = time.perf_counter() - started
+            results.append({
+                "scenario": name,
+                "processed": processed,
+                "seconds": round(elapsed, 3),
+                "per_second": round(processed / elapsed, 1) if elapsed else 0.0,
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+                "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+                "writes": writes.calls,
+                "write_ms_total": round(writes.seconds * 1000, 2),
+                "api_calls": dict(stub.calls),
+                "rss_mb": round(rss_mb(), 1),
+            })
+    finally:
+        await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+    return results
+
+
+def print_table(results, header):
+    print(header)
+    print(f"{'scenario':<12}{'n':>8}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+          f"{'writes':>8}{'write ms':>10}{'rss MB':>9}  api calls")
+    for r in results:
+        calls = ", ".join(f"{method}={n}" for method, n in sorted(r["api_calls"].items()))
+        print(f"{r['scenario']:<12}{r['processed']:>8}{r['per_second']:>10}{r['p50_ms']:>10}{r['p99_ms']:>10}"
+              f"{r['writes']:>8}{r['write_ms_total']:>10}{r['rss_mb']:>9}  {calls}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+
+    # bot.py reads its configuration and data directory at import time
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.environ["TELEGRAM_BOT_TOKEN"] = "1000:bench"
+    os.environ["USER_STORE"] = args.backend
+    os.environ["METRICS_PORT"] = "0"
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, repo_root)
+    os.chdir(workdir)
+    os.makedirs("data", exist_ok=True)
+
+    started = time.perf_counter()
+    seed_users(os.path.join("data", "users.json"), args.users, rng)
+    seed_seconds = time.perf_counter() - started
+
+    import logging
+    logging.disable(logging.INFO)
+    import bot
+
+    bot.rate_limiter.rate = args.broadcast_rate
+    bot.rate_limiter.per_chat_interval = 0
+    stub = StubBotAPI(latency=args.latency)
+    results = asyncio.run(run(args, bot, stub))
+
+    if args.json:
+        print(json.dumps({"users": args.users, "backend": args.backend, "results": results}, indent=2))
+    else:
+        print_table(
+            results,
+            f"{args.users} users, backend={args.backend}, latency={args.latency * 1000:.0f} ms, "
+            f"seeded in {seed_seconds:.1f}s, data in {workdir}"
+        )
+
+
+if __name__ == "__main__":
+    main()
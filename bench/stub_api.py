@@ -0,0 +1,62 @@
+import asyncio
+import json
+import time
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class StubBotAPI(BaseRequest):
+    """Answers Bot API calls locally after a fixed latency instead of calling Telegram.
+
+    Every call is counted per method so a run can report how many API round
+    trips each scenario costs.
+    """
+
+    def __init__(self, latency=0.05, member_status="member"):
+        self.latency = latency
+        self.member_status = member_status
+        self.calls = Counter()
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self._result(api_method, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def _result(self, api_method, params):
+        if api_method == "getMe":
+            return BOT_USER
+        if api_method == "getChatMember":
+            user_id = int(params["user_id"])
+            return {"status": self.member_status, "user": _user(user_id)}
+        if api_method == "getChat":
+            chat_id = int(params["chat_id"])
+            return {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"}
+        if api_method in ("sendMessage", "editMessageText", "sendDocument"):
+            self._message_id += 1
+            chat_id = int(params["chat_id"]) if str(params["chat_id"]).lstrip("-").isdigit() else 1
+            return {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
@@ -0,0 +1,38 @@
+import time
+from itertools import count
+
+_update_ids = count(1)
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def text_update(user_id, text):
+    """Update JSON for a private text message; a leading /command gets its entity."""
+    message = {
+        "message_id": next(_update_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"User{user_id}"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def start_with_referral(user_id, referrer_id):
+    return text_update(user_id, f"/start {referrer_id}")
+
+
+def daily_reward(user_id):
+    return text_update(user_id, "📅 Daily Reward")
+
+
+def leaderboard(user_id):
+    return text_update(user_id, "🏆 Leaderboard")
+
+
+def broadcast(admin_id, message="Benchmark broadcast"):
+    return text_update(admin_id, f"/broadcast {message}")
@@ -1,12 +1,37 @@
+import argparse
+import asyncio
+import csv
+import io
 import logging
 import os
-import json
 import datetime
 import re
+import secrets
 import sys
+import tempfile
+import time
 import traceback
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackContext
+from telegram import Bot, Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, ApplicationHandlerStop, CallbackQueryHandler, ChatMemberHandler, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes, CallbackContext
+
+from broadcast import Broadcaster, RateLimiter
+from bulk import (
+    APPLIED, NOT_FOUND, OPERATIONS, POINTS_OUT_OF_RANGE, UNCHANGED, parse_operation, parse_rows, summarize, write_report,
+)
+from caches import TTLCache
+from config import ConfigWatcher, load_config
+from conversations import Conversations
+from maintenance import Maintenance
+from metrics import REGISTRY, REJECTED_UPDATES, ErrorLogCounter, InstrumentedRequest, instrument, instrument_store, start_metrics_server, track
+from models import INT64_MAX, INT64_MIN, UserRecord, parse_user_id, to_day
+from outbox import Outbox
+from throttle import UserThrottle
+from tasks import TaskRegistry, complete_task
+from storage import JournalStore, SQLiteStore, convert_json_to_snapshot, migrate_json_to_sqlite
+from sharding import ShardSupervisor, run_sharded, serve_shard
+from webhook import SECRET_HEADER, run_webhook
 
 # Set up logging
 logging.basicConfig(
@@ -14,6 +39,10 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# Errors logged while an update is handled count towards that route's error rate
+logging.getLogger().addHandler(ErrorLogCounter())
+# The JobQueue scheduler logs every job run at INFO
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 
 # Bot Token & Channel Details
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -24,16 +53,47 @@ else:
     logger.info(f"Token found with length: {len(TOKEN)}")
     logger.info(f"Token starts with: {TOKEN[:4]}...")
 
-REQUIRED_CHANNELS = ["@fampayearningapp", "@grassnodepayairdrop"]
-CHANNEL_LINKS = {
-    "@fampayearningapp": "https://t.me/fampayearningapp",
-    "@grassnodepayairdrop": "https://t.me/grassnodepayairdrop"
-}
-ADMIN_ID = 848533788
+# Channels, admins, rewards and tasks (see config.py); edits to the file are
+# picked up while the bot runs, every CONFIG_POLL_INTERVAL seconds
+CONFIG_FILE = os.getenv("BOT_CONFIG", "config.json")
+CONFIG_POLL_INTERVAL = 5
+try:
+    config = load_config(CONFIG_FILE)
+except (OSError, ValueError) as e:
+    logger.error(f"Invalid config: {str(e)}")
+    sys.exit(1)
 
 # Initialize data directory and file
 DATA_DIR = "data"
 DATA_FILE = f"{DATA_DIR}/users.json"
+SNAPSHOT_FILE = f"{DATA_DIR}/users.bin"
+DB_FILE = f"{DATA_DIR}/users.db"
+
+# User store backend: "journal" (users.bin + append-only journal) or "sqlite"
+STORE_BACKEND = os.getenv("USER_STORE", "journal")
+
+# Sharded mode (see sharding.py): set for each worker process by the front process
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+
+# Each shard queues its own notifications
+OUTBOX_FILE = f"{DATA_DIR}/outbox.jsonl" if SHARD_COUNT == 1 else f"{DATA_DIR}/outbox-{SHARD_INDEX}.jsonl"
+# and keeps the resume state of the broadcasts it starts; a store lease lets only one run at a time
+BROADCAST_STATE_FILE = f"{DATA_DIR}/broadcast.json" if SHARD_COUNT == 1 else f"{DATA_DIR}/broadcast-{SHARD_INDEX}.json"
+
+# Bot API server, e.g. a self-hosted telegram-bot-api; unset means api.telegram.org
+BOT_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Local Prometheus endpoint (http://METRICS_HOST:METRICS_PORT/metrics); port 0 disables it.
+# Shards serve theirs on METRICS_PORT + SHARD_INDEX.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Scheduled maintenance (see maintenance.py): timestamped store backups every
+# BACKUP_INTERVAL seconds, of which the newest BACKUP_KEEP are kept; 0 disables them
+BACKUP_DIR = f"{DATA_DIR}/backups"
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", str(6 * 60 * 60)))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "28"))
 
 # Create data directory if it doesn't exist
 if not os.path.exists(DATA_DIR):
@@ -41,21 +101,38 @@ if not os.path.exists(DATA_DIR):
 
 async def help_command(update: Update, context: CallbackContext):
     try:
-        await update.message.reply_text(
+        await update.message.reply_text(replies.help_text)
+    except Exception as e:
+        logger.error(f"Error in help_command: {str(e)}")
+        await update.message.reply_text("❌ An error occurred. Please try again.")
+
+class StaticReplies:
+    """Keyboards and fixed texts shared by every handler, built once instead of per update.
+
+    Telegram objects are immutable, so one ReplyKeyboardMarkup can be sent any
+    number of times. ``bind`` fills in what depends on the bot's identity,
+    which the application fetches once when it is initialized.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        rewards = config.rewards
+        task_points = ", ".join(f"+{task.points} points" for task in config.tasks) or "none right now"
+        self.help_text = (
             "ℹ️ Bot Help:\n\n"
             "1. Join our channels to start earning\n"
             "2. Share your referral link with friends\n"
             "3. Earn points through referrals\n"
             "4. Claim daily rewards\n"
             "5. Complete tasks for extra points\n"
-            "6. Claim rewards at 100 points\n\n"
+            f"6. Claim rewards at {rewards['claim_cost']} points\n\n"
             "📌 Points System:\n"
-            "• Referral Bonus (You): +10 points\n"
-            "• Referral Bonus (Friend): +5 points\n"
-            "• Daily Reward: +5 points\n"
-            "• Task Completion: +15 points\n\n"
+            f"• Referral Bonus (You): +{rewards['referrer']} points\n"
+            f"• Referral Bonus (Friend): +{rewards['referred']} points\n"
+            f"• Daily Reward: +{rewards['daily']} points\n"
+            f"• Task Completion: {task_points}\n\n"
             "💰 Rewards:\n"
-            "• 100 points = 1 Reward claim\n\n"
+            f"• {rewards['claim_cost']} points = 1 Reward claim\n\n"
             "🔥 How to earn more:\n"
             "• Share your referral link\n"
             "• Complete daily check-in\n"
@@ -63,153 +140,425 @@ async def help_command(update: Update, context: CallbackContext):
             "• Stay active in channels\n\n"
             "For support: @admin"
         )
-    except Exception as e:
-        logger.error(f"Error in help_command: {str(e)}")
-        await update.message.reply_text("❌ An error occurred. Please try again.")
+        # (text, reply_markup) shown by each task's menu button
+        self.task_prompts = {task.id: self._task_prompt(task) for task in config.tasks}
+
+        self.channels_text = "\n".join(f"{i+1}➡️ {channel}" for i, channel in enumerate(config.channels))
+        self.join_prompt = (
+            "🛑 Join Our Channels If You Want To Use The Bot:\n\n"
+            f"{self.channels_text}\n\n"
+            "✅ Done Subscribed! Click Check"
+        )
+        self.join_info = (
+            "🌟 Welcome to our Earning Community! 🌟\n\n"
+            "Join our official channels to:\n"
+            "• Get instant earning updates\n"
+            "• Access exclusive reward opportunities\n"
+            "• Stay informed about special bonuses\n\n"
+            "Click '🔄 Check Again' after joining to activate your rewards!\n\n"
+            f"Join now:\n{self.channels_text}"
+        )
+
+        self.join_keyboard = ReplyKeyboardMarkup(
+            [[KeyboardButton("✅ Join Channels"), KeyboardButton("🔄 Check Again")]],
+            resize_keyboard=True
+        )
+        # Task buttons fill the row next to Daily Reward, then rows of two
+        task_buttons = [KeyboardButton(task.button) for task in config.tasks]
+        main_rows = [
+            [KeyboardButton("👥 Refer & Earn"), KeyboardButton("💰 My Points")],
+            [KeyboardButton("🎁 Claim Reward"), KeyboardButton("🏆 Leaderboard")],
+            [KeyboardButton("📅 Daily Reward"), *task_buttons[:1]],
+            *(task_buttons[i:i + 2] for i in range(1, len(task_buttons), 2)),
+            [KeyboardButton("ℹ️ Help")]
+        ]
+        self.main_keyboard = ReplyKeyboardMarkup(main_rows, resize_keyboard=True)
+        # The admin also gets a button for the admin panel
+        self.admin_main_keyboard = ReplyKeyboardMarkup(
+            [*main_rows, [KeyboardButton("🔐 Admin Panel")]], resize_keyboard=True
+        )
+        self.admin_keyboard = ReplyKeyboardMarkup([
+            [KeyboardButton("📢 Broadcast"), KeyboardButton("🚫 Ban User")],
+            [KeyboardButton("✅ Unban User"), KeyboardButton("💰 Edit Points")],
+            [KeyboardButton("📊 User Stats"), KeyboardButton("👥 View Users")],
+            [KeyboardButton("🔙 Back")]
+        ], resize_keyboard=True)
+
+        self.cancel_keyboard = ReplyKeyboardMarkup([[KeyboardButton("❌ Cancel")]], resize_keyboard=True)
+        self.confirm_keyboard = ReplyKeyboardMarkup(
+            [[KeyboardButton("✅ Confirm"), KeyboardButton("❌ Cancel")]], resize_keyboard=True
+        )
+
+        self.bot_username = None
+        self.referral_link_prefix = None
 
-# Initialize users dictionary
-def load_data():
-    global users
-    if os.path.exists(DATA_FILE):
+    @staticmethod
+    def _task_prompt(task):
+        if task.verify == "link":
+            return (
+                f"🎯 Complete {task.title} Task:\n\n"
+                "1. Click this link:\n"
+                f"{task.url}\n\n"
+                "2. Complete the registration\n"
+                "3. Send the link back here to verify\n\n"
+                f"Earn {task.points} points upon completion! 🎁"
+            ), None
+        if task.verify == "channel":
+            steps = f"1. Join {task.channel}\n2. Tap ✅ Verify below\n\n"
+            done_button = InlineKeyboardButton("✅ Verify", callback_data=f"task:{task.id}")
+        else:
+            steps = "1. Open the link below\n2. Tap ✅ Done when you have finished\n\n"
+            done_button = InlineKeyboardButton("✅ Done", callback_data=f"task:{task.id}")
+        return (
+            f"🎯 Complete {task.title} Task:\n\n{steps}Earn {task.points} points upon completion! 🎁",
+            InlineKeyboardMarkup([[InlineKeyboardButton(f"🔗 {task.title}", url=task.url)], [done_button]])
+        )
+
+    def bind(self, bot):
+        """Record the bot's identity (a Bot or the User returned by get_me)."""
+        self.bot_username = bot.username
+        self.referral_link_prefix = f"https://t.me/{bot.username}?start="
+
+    def main_menu(self, user_id):
+        return self.admin_main_keyboard if self.config.is_admin(user_id) else self.main_keyboard
+
+replies = StaticReplies(config)
+
+# Created by init_store(), called from build_application()
+store = None
+broadcaster = None
+maintenance = None
+
+# Shared by everything that sends to many chats, so together they stay under Telegram's limits.
+# Shards split the bot-wide limit evenly, except that the one sending a broadcast
+# takes all of it meanwhile (the others rarely send much); a RetryAfter pauses it if overshot.
+SEND_RATE = 30
+rate_limiter = RateLimiter(rate=SEND_RATE / SHARD_COUNT, per_chat_interval=1.0)
+
+def render_referrals(entries):
+    """One message for every referral credited to a referrer since the last one was sent."""
+    latest = entries[-1]["data"]
+    # Entries queued before the amount was recorded were credited the fixed 10 points
+    earned = sum(entry["data"].get("points_earned", 10) for entry in entries)
+    if len(entries) == 1:
+        return {"text": f"🎉 New Referral Success!\n\n"
+                        f"User: {latest['user_name']}\n"
+                        f"You earned: +{earned} points 🎁\n"
+                        f"Total referrals: {latest['referrals']}\n"
+                        f"Current balance: {latest['points']} points"}
+    names = ", ".join(entry["data"]["user_name"] for entry in entries)
+    return {"text": f"🎉 You got {len(entries)} new referrals!\n\n"
+                    f"Users: {names}\n"
+                    f"You earned: +{earned} points 🎁\n"
+                    f"Total referrals: {latest['referrals']}\n"
+                    f"Current balance: {latest['points']} points"}
+
+# Notifications to users other than the sender of the current update
+outbox = Outbox(OUTBOX_FILE, rate_limiter)
+outbox.register("referral", render_referrals, coalesce=True)
+
+def notify_admins(text, **kwargs):
+    for admin_id in config.admins:
+        outbox.enqueue(admin_id, text, **kwargs)
+
+REGISTRY.gauge("bot_outbox_pending", "Notifications queued and not yet sent", lambda: len(outbox))
+REGISTRY.gauge("bot_store_pending_writes", "Store writes accepted but not yet durable",
+               lambda: store.pending_writes() if store is not None else 0)
+REGISTRY.gauge("bot_broadcast_running", "1 while a broadcast is being sent",
+               lambda: int(broadcaster is not None and broadcaster.running))
+metrics_runner = None
+
+def init_store():
+    """Create the user store and the objects that depend on it; nothing is read from disk yet."""
+    global store, broadcaster, maintenance
+    if STORE_BACKEND == "sqlite":
+        store = SQLiteStore(DB_FILE, shared=SHARD_COUNT > 1)
+    else:
+        store = JournalStore(SNAPSHOT_FILE)
+    instrument_store(store)
+    broadcaster = Broadcaster(store, BROADCAST_STATE_FILE, rate_limiter, owner=f"shard-{SHARD_INDEX}", rate=SEND_RATE)
+    maintenance = Maintenance(
+        store, BACKUP_DIR, os.path.basename(DB_FILE if STORE_BACKEND == "sqlite" else SNAPSHOT_FILE),
+        backup_interval=BACKUP_INTERVAL, backup_keep=BACKUP_KEEP,
+    )
+
+def prepare_store():
+    """Convert older data files for the configured backend; a no-op once done."""
+    if STORE_BACKEND == "sqlite" and not os.path.exists(DB_FILE):
+        source = SNAPSHOT_FILE if os.path.exists(SNAPSHOT_FILE) else DATA_FILE
+        if os.path.exists(source):
+            migrated = migrate_json_to_sqlite(source, DB_FILE)
+            logger.info(f"Migrated {migrated} users from {source} to {DB_FILE}")
+    elif STORE_BACKEND != "sqlite" and not os.path.exists(SNAPSHOT_FILE) and os.path.exists(DATA_FILE):
+        # One-time conversion; users.json and its journal are no longer read afterwards
+        converted = convert_json_to_snapshot(DATA_FILE, SNAPSHOT_FILE)
+        logger.info(f"Converted {converted} users from {DATA_FILE} to {SNAPSHOT_FILE}")
+
+async def load_data(application: Application):
+    prepare_store()
+    # Application.initialize() has already called get_me, so this is no extra request
+    replies.bind(application.bot)
+    await store.open()
+    logger.info(f"User store ready ({STORE_BACKEND}): {await store.count()} users")
+    await refresh_banned_users()
+    await broadcaster.resume(application)
+    outbox.start(application.bot)
+    schedule_maintenance(application)
+
+    global metrics_runner
+    if METRICS_PORT and metrics_runner is None:
         try:
-            with open(DATA_FILE, "r") as f:
-                users = json.load(f)
-        except json.JSONDecodeError:
-            users = {}
-            logger.error("Error reading users file, starting with empty users dict")
+            metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT + SHARD_INDEX)
+        except OSError as e:
+            logger.error(f"Could not start metrics server: {str(e)}")
+
+async def save_data(application: Application):
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+    await outbox.stop()
+    await store.close()
+
+def schedule_maintenance(application: Application):
+    if application.job_queue is None:
+        logger.warning("No JobQueue (install python-telegram-bot[job-queue]); backups, cache pruning "
+                       "and config reloading are off")
+        return
+    application.job_queue.run_repeating(config_watcher.poll_job, CONFIG_POLL_INTERVAL, name="config")
+    for name, cache in (("names", name_cache), ("membership", membership_cache), ("burst_alerts", burst_alerts),
+                        ("gate_notices", gate_notices), ("throttle", throttle), ("conversations", conversations)):
+        maintenance.add_cache(name, cache)
+    # Shards share one database, so one of them backs it up
+    maintenance.schedule(application.job_queue, backups=SHARD_INDEX == 0)
+
+# Checked by gate() on every update; ban_user/unban_user keep it current.
+# Shards reload it every BANNED_REFRESH seconds to see bans made on another shard.
+banned_users = {"ids": set(), "loaded_at": 0.0}
+BANNED_REFRESH = 30
+
+async def refresh_banned_users():
+    banned_users["loaded_at"] = time.monotonic()
+    banned_users["ids"] = await store.banned_users()
+
+# Per-user flood limit: bursts of THROTTLE_BURST updates, THROTTLE_RATE per second sustained
+THROTTLE_RATE = 1.0
+THROTTLE_BURST = 10
+throttle = UserThrottle(rate=THROTTLE_RATE, burst=THROTTLE_BURST)
+# Rejected users are told why at most once per minute
+gate_notices = TTLCache(maxsize=10_000, ttl=60)
+GATE_NOTICES = {
+    "banned": "🚫 You are banned from using this bot.",
+    "throttled": "⏳ Too many requests. Please slow down and try again in a moment.",
+}
+
+async def gate(update: Update, context: CallbackContext):
+    """Runs first (group -1) and stops updates from banned or flooding users before any handler.
+
+    Only in-memory state is consulted, so a rejected update costs no Bot API
+    call and no store access.
+    """
+    user = update.effective_user
+    if user is None or config.is_admin(user.id) or (update.message is None and update.callback_query is None):
+        return
+    if SHARD_COUNT > 1 and time.monotonic() - banned_users["loaded_at"] > BANNED_REFRESH:
+        await refresh_banned_users()
+
+    if user.id in banned_users["ids"]:
+        reason = "banned"
+    elif not throttle.allow(user.id):
+        reason = "throttled"
     else:
-        users = {}
+        return
 
-load_data()
+    REJECTED_UPDATES.inc(reason)
+    if gate_notices.get((user.id, reason)) is None:
+        gate_notices.set((user.id, reason), True)
+        outbox.enqueue(update.effective_chat.id, GATE_NOTICES[reason])
+    raise ApplicationHandlerStop
 
-def save_data():
-    try:
-        # Create backup of existing file
-        if os.path.exists(DATA_FILE):
-            backup_file = f"{DATA_FILE}.backup"
+# Display names seen on incoming updates, so the leaderboard rarely needs get_chat
+name_cache = TTLCache(maxsize=50_000, ttl=24 * 60 * 60)
+NAME_LOOKUP_CONCURRENCY = 5
+
+async def remember_user(update: Update, context: CallbackContext):
+    """Record the sender's first name from every update; the store is only written when it changes."""
+    user = update.effective_user
+    if user is None or not user.first_name:
+        return
+    user_id = user.id
+    if name_cache.get(user_id) == user.first_name:
+        return
+    name_cache.set(user_id, user.first_name)
+
+    async with store.transaction(user_id) as tx:
+        user_data = tx.get(user_id)
+        if user_data is not None:
+            user_data.name = user.first_name
+
+async def resolve_names(context: CallbackContext, user_ids):
+    """Return {user_id: name}, fetching cache misses concurrently from the Bot API."""
+    names = {}
+    missing = []
+    for user_id in user_ids:
+        name = name_cache.get(user_id)
+        if name:
+            names[user_id] = name
+        else:
+            missing.append(user_id)
+
+    semaphore = asyncio.Semaphore(NAME_LOOKUP_CONCURRENCY)
+
+    async def fetch(user_id):
+        async with semaphore:
             try:
-                with open(DATA_FILE, 'r') as src, open(backup_file, 'w') as dst:
-                    dst.write(src.read())
-            except Exception as e:
-                logger.error(f"Error creating backup: {str(e)}")
-
-        # Save new data
-        with open(DATA_FILE, "w") as f:
-            json.dump(users, f, indent=4)
-    except Exception as e:
-        logger.error(f"Error saving data: {str(e)}")
+                chat = await context.bot.get_chat(user_id)
+                return chat.first_name
+            except Exception:
+                return None
+
+    for user_id, name in zip(missing, await asyncio.gather(*(fetch(user_id) for user_id in missing))):
+        if name:
+            name_cache.set(user_id, name)
+            names[user_id] = name
+    return names
 
 def is_valid_email(email):
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
     return re.match(pattern, email) is not None
 
+# Channel membership per (user_id, channel); "not a member" is re-checked sooner
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+MEMBERSHIP_TTL = 10 * 60
+NON_MEMBERSHIP_TTL = 30
+membership_cache = TTLCache(maxsize=200_000, ttl=MEMBERSHIP_TTL)
+
+async def is_channel_member(context: CallbackContext, channel, user_id) -> bool:
+    key = (user_id, channel)
+    cached = membership_cache.get(key)
+    if cached is not None:
+        return cached
+    chat_member = await context.bot.get_chat_member(chat_id=channel, user_id=user_id)
+    is_member = chat_member.status in MEMBER_STATUSES
+    membership_cache.set(key, is_member, ttl=None if is_member else NON_MEMBERSHIP_TTL)
+    return is_member
+
 async def check_channel_membership(update: Update, context: CallbackContext) -> bool:
     try:
-        for channel in REQUIRED_CHANNELS:
-            chat_member = await context.bot.get_chat_member(chat_id=channel, user_id=update.effective_user.id)
-            if chat_member.status not in ['member', 'administrator', 'creator']:
-                return False
-        return True
+        user_id = update.effective_user.id
+        results = await asyncio.gather(
+            *(is_channel_member(context, channel, user_id) for channel in config.channels)
+        )
+        return all(results)
     except Exception as e:
         logger.error(f"Error checking channel membership: {str(e)}")
         return False
 
+async def track_channel_member(update: Update, context: CallbackContext):
+    """Keep the membership cache in sync when someone joins or leaves a required channel.
+
+    Only delivered when the bot is an administrator of the channel.
+    """
+    change = update.chat_member
+    if not change.chat.username:
+        return
+    channel = f"@{change.chat.username}".lower()
+    for required in config.channels:
+        if required.lower() == channel:
+            is_member = change.new_chat_member.status in MEMBER_STATUSES
+            membership_cache.set(
+                (change.new_chat_member.user.id, required), is_member,
+                ttl=None if is_member else NON_MEMBERSHIP_TTL
+            )
+
+# Referral velocity that suggests a farm of fake accounts
+BURST_WINDOW = 60 * 60
+BURST_THRESHOLD = 20
+# Referrers already reported, so the admin gets one alert per burst
+burst_alerts = TTLCache(maxsize=10_000, ttl=BURST_WINDOW)
+
+async def check_referral_burst(context: CallbackContext, referrer_id):
+    if burst_alerts.get(referrer_id):
+        return
+    count = await store.referrals_since(referrer_id, int(time.time()) - BURST_WINDOW)
+    if count < BURST_THRESHOLD:
+        return
+    burst_alerts.set(referrer_id, True)
+    logger.warning(f"Referral burst - Referrer: {referrer_id}, {count} referrals in the last hour")
+    notify_admins(
+        f"⚠️ Suspicious referrals!\n\n"
+        f"User {referrer_id} referred {count} users in the last hour.\n"
+        f"Check with /downline {referrer_id}"
+    )
+
 async def start(update: Update, context: CallbackContext):
     try:
         if not await check_channel_membership(update, context):
-            channels_text = "\n".join([f"{i+1}➡️ {channel}" for i, channel in enumerate(REQUIRED_CHANNELS)])
-            keyboard = [
-                [KeyboardButton("✅ Join Channels"), KeyboardButton("🔄 Check Again")]
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            await update.message.reply_text(
-                "🛑 Join Our Channels If You Want To Use The Bot:\n\n"
-                f"{channels_text}\n\n"
-                "✅ Done Subscribed! Click Check",
-                reply_markup=reply_markup
-            )
+            await update.message.reply_text(replies.join_prompt, reply_markup=replies.join_keyboard)
             return
 
-        user_id = str(update.effective_user.id)
+        user_id = update.effective_user.id
         user_name = update.effective_user.first_name
 
         # Initialize user data if new
-        if user_id not in users:
-            users[user_id] = {
-                "points": 0,
-                "referrals": 0,
-                "email": "",
-                "rewards_claimed": 0,
-                "awaiting_email": False,
-                "has_been_referred": False,
-                "referrer_id": None,
-                "last_daily_claim": ""
-            }
-            save_data()
+        async with store.transaction(user_id) as tx:
+            user = tx.get(user_id)
+            if user is None:
+                user = tx.create(user_id, UserRecord(name=user_name or ""))
+            # Someone who blocked the bot and came back gets broadcasts again
+            user.blocked = False
 
         # Handle referral
         if context.args and context.args[0]:
-            referrer_id = str(context.args[0])
-            logger.info(f"Referral attempt - User: {user_id}, Referrer: {referrer_id}")
-            
-            # Check if referrer exists and is not the same as user
-            if referrer_id in users and referrer_id != user_id:
-                # Check if user has already been referred
-                if not users[user_id].get("has_been_referred", False):
-                    # Update new user's data
-                    users[user_id]["points"] = users[user_id].get("points", 0) + 5
-                    users[user_id]["has_been_referred"] = True
-                    users[user_id]["referrer_id"] = referrer_id
-
-                    # Update referrer's data
-                    users[referrer_id]["points"] = users[referrer_id].get("points", 0) + 10
-                    users[referrer_id]["referrals"] = users[referrer_id].get("referrals", 0) + 1
-
-                    save_data()
-
-                    # Send confirmation to new user
-                    await update.message.reply_text(
-                        f"🎉 Congratulations!\n\n"
-                        f"You've earned: +5 points 🎁\n"
-                        f"Current balance: {users[user_id]['points']} points\n\n"
-                        f"Start earning more by sharing your referral link! 🔗"
-                    )
-
-                    # Send confirmation to referrer
-                    try:
-                        await context.bot.send_message(
-                            chat_id=referrer_id,
-                            text=f"🎉 New Referral Success!\n\n"
-                                f"User: {user_name}\n"
-                                f"You earned: +10 points 🎁\n"
-                                f"Total referrals: {users[referrer_id]['referrals']}\n"
-                                f"Current balance: {users[referrer_id]['points']} points"
-                        )
-                        logger.info(f"Referral success - Referrer: {referrer_id}, User: {user_id}")
-                    except Exception as e:
-                        logger.error(f"Could not send message to referrer: {e}")
-
-        # Create keyboard with main options
-        keyboard = [
-            [KeyboardButton("👥 Refer & Earn"), KeyboardButton("💰 My Points")],
-            [KeyboardButton("🎁 Claim Reward"), KeyboardButton("🏆 Leaderboard")],
-            [KeyboardButton("📅 Daily Reward"), KeyboardButton("🔥 Midas RWA Task")],
-            [KeyboardButton("ℹ️ Help")]
-        ]
+            referrer_id = parse_user_id(context.args[0])
+            logger.info(f"Referral attempt - User: {user_id}, Referrer: {context.args[0]}")
+
+            referred = False
+            rewards = config.rewards
+            if referrer_id is not None and referrer_id != user_id:
+                # Both records change together, so lock both users
+                async with store.transaction(user_id, referrer_id) as tx:
+                    user = tx.get(user_id)
+                    referrer = tx.get(referrer_id)
+                    # Check if referrer exists and user has not already been referred
+                    if referrer is not None and not user.has_been_referred:
+                        # Update new user's data
+                        user.points += rewards["referred"]
+                        user.has_been_referred = True
+                        user.referrer_id = referrer_id
+                        user.referred_at = int(time.time())
+
+                        # Update referrer's data
+                        referrer.points += rewards["referrer"]
+                        referrer.referrals += 1
+                        referred = True
+
+            if referred:
+                # Send confirmation to new user
+                await update.message.reply_text(
+                    f"🎉 Congratulations!\n\n"
+                    f"You've earned: +{rewards['referred']} points 🎁\n"
+                    f"Current balance: {user.points} points\n\n"
+                    f"Start earning more by sharing your referral link! 🔗"
+                )
 
-        # Add admin panel button for admin
-        if str(update.effective_user.id) == str(ADMIN_ID):
-            keyboard.append([KeyboardButton("🔐 Admin Panel")])
+                # Send confirmation to referrer
+                outbox.enqueue(
+                    referrer_id, kind="referral",
+                    user_name=user_name, referrals=referrer.referrals, points=referrer.points,
+                    points_earned=rewards["referrer"]
+                )
+                logger.info(f"Referral success - Referrer: {referrer_id}, User: {user_id}")
 
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+                await check_referral_burst(context, referrer_id)
 
         # Show welcome message
         await update.message.reply_text(
             f"👋 Welcome {user_name}!\n\n"
-            f"📊 Points: {users[user_id]['points']}\n"
-            f"👥 Referrals: {users[user_id].get('referrals', 0)}\n\n"
+            f"📊 Points: {user.points}\n"
+            f"👥 Referrals: {user.referrals}\n\n"
             "Choose an option from the menu below:",
-            reply_markup=reply_markup
+            reply_markup=replies.main_menu(user_id)
         )
 
     except Exception as e:
@@ -220,19 +569,21 @@ async def start(update: Update, context: CallbackContext):
 
 async def refer_earn(update: Update, context: CallbackContext):
     try:
-        user_id = str(update.effective_user.id)
-        bot = await context.bot.get_me()
-        referral_link = f"https://t.me/{bot.username}?start={user_id}"
+        user_id = update.effective_user.id
+        if replies.referral_link_prefix is None:
+            # Only before load_data has run, e.g. when a handler is driven directly
+            replies.bind(await context.bot.get_me())
+        referral_link = f"{replies.referral_link_prefix}{user_id}"
         
-        user_data = users.get(user_id, {})
-        referrals_count = user_data.get('referrals', 0)
-        total_earnings = user_data.get('points', 0)
+        user_data = await store.get(user_id) or UserRecord()
+        referrals_count = user_data.referrals
+        total_earnings = user_data.points
         
         message = (
             "🔥 Refer & Earn Program:\n\n"
             "Earn points by inviting friends:\n"
-            "• You get: 10 points per referral\n"
-            "• Friend gets: 5 points for joining\n\n"
+            f"• You get: {config.rewards['referrer']} points per referral\n"
+            f"• Friend gets: {config.rewards['referred']} points for joining\n\n"
             f"Your Stats:\n"
             f"• Total Referrals: {referrals_count}\n"
             f"• Total Points: {total_earnings}\n\n"
@@ -248,24 +599,21 @@ async def refer_earn(update: Update, context: CallbackContext):
 
 async def check_daily_reward(update: Update, context: CallbackContext):
     try:
-        user_id = str(update.effective_user.id)
-        today = str(datetime.date.today())
-
-        if user_id not in users:
-            users[user_id] = {
-                "points": 0,
-                "referrals": 0,
-                "email": "",
-                "rewards_claimed": 0,
-                "last_daily_claim": "",
-                "awaiting_email": False
-            }
-
-        if users[user_id]["last_daily_claim"] != today:
-            reward_points = 5
-            users[user_id]["points"] = users[user_id].get("points", 0) + reward_points
-            users[user_id]["last_daily_claim"] = today
-            save_data()
+        user_id = update.effective_user.id
+        today = to_day(datetime.date.today())
+
+        reward_points = config.rewards["daily"]
+        async with store.transaction(user_id) as tx:
+            user = tx.get(user_id)
+            if user is None:
+                user = tx.create(user_id, UserRecord())
+
+            claimed = user.last_daily_claim != today
+            if claimed:
+                user.points += reward_points
+                user.last_daily_claim = today
+
+        if claimed:
             await update.message.reply_text(f"🎁 Daily Reward Claimed!\n+{reward_points} points!")
         else:
             await update.message.reply_text("❌ You've already claimed your daily reward today.\nCome back tomorrow!")
@@ -275,21 +623,14 @@ async def check_daily_reward(update: Update, context: CallbackContext):
 
 # Admin Commands
 async def admin_panel(update: Update, context: CallbackContext):
-    if str(update.effective_user.id) != str(ADMIN_ID):
+    if not config.is_admin(update.effective_user.id):
         await update.message.reply_text("❌ Access denied!")
         return
 
-    keyboard = [
-        [KeyboardButton("📢 Broadcast"), KeyboardButton("🚫 Ban User")],
-        [KeyboardButton("✅ Unban User"), KeyboardButton("💰 Edit Points")],
-        [KeyboardButton("📊 User Stats"), KeyboardButton("👥 View Users")],
-        [KeyboardButton("🔙 Back")]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("🔐 Admin Panel:", reply_markup=reply_markup)
+    await update.message.reply_text("🔐 Admin Panel:", reply_markup=replies.admin_keyboard)
 
 async def broadcast_message(update: Update, context: CallbackContext):
-    if str(update.effective_user.id) != str(ADMIN_ID):
+    if not config.is_admin(update.effective_user.id):
         return
 
     if len(context.args) == 0:
@@ -297,110 +638,334 @@ async def broadcast_message(update: Update, context: CallbackContext):
         return
 
     message = ' '.join(context.args)
-    success_count = 0
 
-    for user_id in users:
-        try:
-            await context.bot.send_message(chat_id=user_id, text=message)
-            success_count += 1
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to {user_id}: {str(e)}")
-
-    await update.message.reply_text(f"✅ Broadcast sent to {success_count} users")
+    if not await broadcaster.start(context.application, message, update.effective_chat.id):
+        await update.message.reply_text("⏳ A broadcast is already running. Wait for it to finish.")
 
 async def ban_user(update: Update, context: CallbackContext):
-    if str(update.effective_user.id) != str(ADMIN_ID):
+    if not config.is_admin(update.effective_user.id):
         return
 
     if len(context.args) == 0:
         await update.message.reply_text("Usage: /ban <user_id>")
         return
 
-    user_id = context.args[0]
-    if user_id in users:
-        users[user_id]["banned"] = True
-        save_data()
+    user_id = parse_user_id(context.args[0])
+    if user_id is None:
+        await update.message.reply_text("❌ User not found")
+        return
+
+    async with store.transaction(user_id) as tx:
+        user = tx.get(user_id)
+        if user is not None:
+            user.banned = True
+    if user is not None:
+        banned_users["ids"].add(user_id)
         await update.message.reply_text(f"🚫 User {user_id} has been banned")
     else:
         await update.message.reply_text("❌ User not found")
 
 async def unban_user(update: Update, context: CallbackContext):
-    if str(update.effective_user.id) != str(ADMIN_ID):
+    if not config.is_admin(update.effective_user.id):
         return
 
     if len(context.args) == 0:
         await update.message.reply_text("Usage: /unban <user_id>")
         return
 
-    user_id = context.args[0]
-    if user_id in users:
-        users[user_id]["banned"] = False
-        save_data()
+    user_id = parse_user_id(context.args[0])
+    if user_id is None:
+        await update.message.reply_text("❌ User not found")
+        return
+
+    async with store.transaction(user_id) as tx:
+        user = tx.get(user_id)
+        if user is not None:
+            user.banned = False
+    if user is not None:
+        banned_users["ids"].discard(user_id)
         await update.message.reply_text(f"✅ User {user_id} has been unbanned")
     else:
         await update.message.reply_text("❌ User not found")
 
 async def edit_points(update: Update, context: CallbackContext):
-    if str(update.effective_user.id) != str(ADMIN_ID):
+    if not config.is_admin(update.effective_user.id):
         return
 
     if len(context.args) < 2:
         await update.message.reply_text("Usage: /points <user_id> <points>")
         return
 
-    user_id = context.args[0]
+    user_id = parse_user_id(context.args[0])
     try:
         points = int(context.args[1])
     except ValueError:
         await update.message.reply_text("❌ Points must be a number")
         return
+    if not INT64_MIN <= points <= INT64_MAX:
+        await update.message.reply_text(f"❌ Points must be between {INT64_MIN} and {INT64_MAX}")
+        return
+    if user_id is None:
+        await update.message.reply_text("❌ User not found")
+        return
 
-    if user_id in users:
-        users[user_id]["points"] = points
-        save_data()
+    async with store.transaction(user_id) as tx:
+        user = tx.get(user_id)
+        if user is not None:
+            user.points = points
+    if user is not None:
         await update.message.reply_text(f"💰 Set {points} points for user {user_id}")
     else:
         await update.message.reply_text("❌ User not found")
 
+# Bot API downloads stop at 20 MB; at roughly 15 bytes a row that is over a million rows
+BULK_MAX_BYTES = 20 * 1024 * 1024
+
+async def bulk_update(update: Update, context: CallbackContext):
+    """Apply /points, /ban or /unban (the document's caption) to every user listed in an uploaded file.
+
+    All rows are applied in one store transaction, so they are written
+    together in one batch, and the admin gets back a CSV with the result of
+    every row.
+    """
+    if not config.is_admin(update.effective_user.id):
+        return
+
+    message = update.message
+    operation = parse_operation(message.caption)
+    if operation is None:
+        await message.reply_text(
+            "Send the file with /points, /ban or /unban as its caption.\n"
+            "One user ID per line; for /points add the points after a comma "
+            "(50 sets the balance, +50 or -50 changes it)."
+        )
+        return
+    if (message.document.file_size or 0) > BULK_MAX_BYTES:
+        await message.reply_text("❌ The file is too large (20 MB at most)")
+        return
+
+    file = await message.document.get_file()
+    data = await file.download_as_bytearray()
+    try:
+        rows = parse_rows(bytes(data), OPERATIONS[operation])
+    except UnicodeDecodeError:
+        await message.reply_text("❌ The file must be UTF-8 text (CSV or one user ID per line)")
+        return
+
+    started = time.perf_counter()
+    pending = [row for row in rows if row.result is None]
+    if pending:
+        async with store.transaction(*(row.user_id for row in pending)) as tx:
+            for row in pending:
+                user = tx.get(row.user_id)
+                if user is None:
+                    row.result = NOT_FOUND
+                    continue
+                if operation == "points":
+                    is_delta, amount = row.points
+                    points = user.points + amount if is_delta else amount
+                    if not INT64_MIN <= points <= INT64_MAX:
+                        row.result = POINTS_OUT_OF_RANGE
+                        continue
+                    changed = points != user.points
+                    user.points = points
+                else:
+                    banned = operation == "ban"
+                    changed = user.banned != banned
+                    user.banned = banned
+                row.result = APPLIED if changed else UNCHANGED
+    if operation != "points":
+        changed_ids = {row.user_id for row in pending if row.result == APPLIED}
+        if operation == "ban":
+            banned_users["ids"] |= changed_ids
+        else:
+            banned_users["ids"] -= changed_ids
+    elapsed = time.perf_counter() - started
+
+    await context.bot.send_document(
+        chat_id=update.effective_chat.id,
+        document=InputFile(io.BytesIO(write_report(rows)), filename=f"{operation}-results.csv"),
+        caption=f"✅ /{operation}: {len(rows)} rows processed in {elapsed:.1f}s\n{summarize(rows)}"
+    )
+
+USERS_PAGE_SIZE = 20
+
+async def render_users_page(after=None, before=None):
+    """Build one page of the admin user listing and its navigation keyboard.
+
+    One extra row is fetched to find out whether there is a page beyond this one.
+    """
+    rows = await store.list_users(after=after, before=before, limit=USERS_PAGE_SIZE + 1)
+    if before is not None:
+        has_prev, has_next = len(rows) > USERS_PAGE_SIZE, True
+        rows = rows[-USERS_PAGE_SIZE:]
+    else:
+        has_prev, has_next = after is not None, len(rows) > USERS_PAGE_SIZE
+        rows = rows[:USERS_PAGE_SIZE]
+
+    if not rows:
+        return "👥 No users yet!", None
+
+    lines = [f"👥 All Users ({await store.count()} total):\n"]
+    for user_id, user in rows:
+        user_link = f"[{user_id}](tg://user?id={user_id})"
+        lines.append(
+            f"• {user_link}\n  Points: {user.points} | Referrals: {user.referrals}\n"
+        )
+
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"users:before:{rows[0][0]}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Next ➡️", callback_data=f"users:after:{rows[-1][0]}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("📤 Export CSV", callback_data="users:export")])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
 async def view_users(update: Update, context: CallbackContext):
-    if str(update.effective_user.id) != str(ADMIN_ID):
+    if not config.is_admin(update.effective_user.id):
         await update.message.reply_text("❌ Access denied!")
         return
 
-    message = "👥 All Users:\n\n"
-    for user_id in users:
-        user_link = f"[{user_id}](tg://user?id={user_id})"
-        points = users[user_id]["points"]
-        referrals = users[user_id]["referrals"]
-        message += f"• {user_link}\n  Points: {points} | Referrals: {referrals}\n\n"
+    message, reply_markup = await render_users_page()
+    await update.message.reply_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+
+async def view_users_page(update: Update, context: CallbackContext):
+    query = update.callback_query
+    if not config.is_admin(query.from_user.id):
+        await query.answer("❌ Access denied!")
+        return
+
+    _, action, *rest = query.data.split(":", 2)
+    if action == "export":
+        await query.answer("📤 Preparing export...")
+        await send_users_csv(context, query.message.chat_id)
+        return
+
+    cursor = parse_user_id(rest[0]) if rest else None
+    if action == "before":
+        message, reply_markup = await render_users_page(before=cursor)
+    else:
+        message, reply_markup = await render_users_page(after=cursor)
+    await query.answer()
+    await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+
+async def send_users_csv(context: CallbackContext, chat_id):
+    """Stream every user into a temporary CSV file and upload it as a document."""
+    with tempfile.TemporaryFile() as raw:
+        text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(["user_id", "name", "points", "referrals", "rewards_claimed", "banned", "referrer_id"])
+        async for user_id, user in store.iter_users():
+            writer.writerow([
+                user_id, user.name, user.points, user.referrals,
+                user.rewards_claimed, int(user.banned), user.referrer_id or "",
+            ])
+        text.flush()
+        raw.seek(0)
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=InputFile(raw, filename=f"users-{datetime.date.today()}.csv"),
+            caption="👥 All users"
+        )
+        text.detach()
+
+async def export_users(update: Update, context: CallbackContext):
+    if not config.is_admin(update.effective_user.id):
+        return
+    await send_users_csv(context, update.effective_chat.id)
+
+DOWNLINE_DEPTH = 3
+DOWNLINE_LISTED = 20
+
+async def show_downline(update: Update, context: CallbackContext):
+    if not config.is_admin(update.effective_user.id):
+        return
+
+    if len(context.args) == 0:
+        await update.message.reply_text("Usage: /downline <user_id>")
+        return
+
+    user_id = parse_user_id(context.args[0])
+    user = await store.get(user_id) if user_id is not None else None
+    if user is None:
+        await update.message.reply_text("❌ User not found")
+        return
+
+    now = int(time.time())
+    downline = await store.downline(user_id, max_depth=DOWNLINE_DEPTH)
+    per_level = [sum(1 for _, depth in downline if depth == level) for level in range(1, DOWNLINE_DEPTH + 1)]
+    direct = [child for child, depth in downline if depth == 1]
+
+    lines = [
+        f"🕸 Referral tree of {user_id}:\n",
+        f"Referred by: {user.referrer_id or '-'}",
+        f"Levels 1-{DOWNLINE_DEPTH}: " + " / ".join(str(count) for count in per_level),
+        f"Last hour: {await store.referrals_since(user_id, now - 60 * 60)}",
+        f"Last 24h: {await store.referrals_since(user_id, now - 24 * 60 * 60)}",
+    ]
+    if direct:
+        lines.append(f"\nDirect referrals (last {min(len(direct), DOWNLINE_LISTED)}):")
+        lines.extend(f"• {child}" for child in direct[-DOWNLINE_LISTED:])
+    await update.message.reply_text("\n".join(lines))
+
+async def suspicious_referrers(update: Update, context: CallbackContext):
+    if not config.is_admin(update.effective_user.id):
+        return
+
+    try:
+        hours = int(context.args[0]) if context.args else 24
+    except ValueError:
+        await update.message.reply_text("Usage: /suspicious [hours]")
+        return
+
+    bursts = await store.referral_bursts(int(time.time()) - hours * 60 * 60, BURST_WINDOW, BURST_THRESHOLD)
+    if not bursts:
+        await update.message.reply_text(f"✅ No referral bursts in the last {hours}h.")
+        return
 
-    await update.message.reply_text(message, parse_mode='Markdown')
+    lines = [f"⚠️ Referral bursts in the last {hours}h (≥{BURST_THRESHOLD} per hour):\n"]
+    for referrer_id, peak, total in bursts[:DOWNLINE_LISTED]:
+        lines.append(f"• {referrer_id}: peak {peak}/h, {total} total")
+    await update.message.reply_text("\n".join(lines))
 
 async def user_stats(update: Update, context: CallbackContext):
-    if str(update.effective_user.id) != str(ADMIN_ID):
+    if not config.is_admin(update.effective_user.id):
         return
 
-    total_users = len(users)
-    total_points = sum(user["points"] for user in users.values())
-    banned_users = sum(1 for user in users.values() if user.get("banned", False))
+    totals = await store.stats()
+    total_users = totals["total_users"]
+    total_points = totals["total_points"]
+    banned_users = totals["banned_users"]
+
+    today = datetime.date.today()
+    claims = await store.daily_claims(today - datetime.timedelta(days=6), today)
+    active_today = claims[-1][1]
+    claims_text = "\n".join(f"  {day[5:]}: {count}" for day, count in claims)
 
     stats = f"📊 Bot Statistics:\n\n" \
            f"👥 Total Users: {total_users}\n" \
            f"💰 Total Points: {total_points}\n" \
-           f"🚫 Banned Users: {banned_users}"
+           f"🚫 Banned Users: {banned_users}\n" \
+           f"📵 Blocked the Bot: {totals['blocked_users']}\n\n" \
+           f"🔗 Total Referrals: {totals['total_referrals']}\n" \
+           f"🙋 Referred Users: {totals['referred_users']}\n" \
+           f"🎁 Rewards Claimed: {totals['rewards_claimed']}\n\n" \
+           f"📅 Active Today (daily reward): {active_today}\n" \
+           f"📈 Daily Claims, last 7 days:\n{claims_text}"
 
     await update.message.reply_text(stats)
 
 async def my_points(update: Update, context: CallbackContext):
     try:
-        user_id = str(update.effective_user.id)
-        user_data = users.get(user_id, {"points": 0, "referrals": 0})
+        user_id = update.effective_user.id
+        user_data = await store.get(user_id) or UserRecord()
         
         message = (
             "💰 Your Account Status:\n\n"
-            f"• Points Balance: {user_data['points']}\n"
-            f"• Total Referrals: {user_data['referrals']}\n"
-            f"• Rewards Claimed: {user_data.get('rewards_claimed', 0)}\n\n"
+            f"• Points Balance: {user_data.points}\n"
+            f"• Total Referrals: {user_data.referrals}\n"
+            f"• Rewards Claimed: {user_data.rewards_claimed}\n\n"
             "🎯 Need more points?\n"
             "• Share your referral link\n"
             "• Complete daily check-in\n"
@@ -412,86 +977,145 @@ async def my_points(update: Update, context: CallbackContext):
         logger.error(f"Error in my_points: {str(e)}")
         await update.message.reply_text("❌ An error occurred. Please try again.")
 
+# Multi-step flows. State is per process, which is enough because all of a
+# user's updates reach the same process (see sharding.py).
+conversations = Conversations(ttl=10 * 60)
+
 async def claim_reward(update: Update, context: CallbackContext):
     try:
-        user_id = str(update.effective_user.id)
-        user_data = users.get(user_id, {"points": 0})
-
-        if user_data["points"] < 100:
-            await update.message.reply_text(
-                "❌ You need at least 100 points to claim a reward!\n"
-                f"Current points: {user_data['points']}\n"
-                f"Points needed: {100 - user_data['points']}"
-            )
-            return
-
-        if not user_data.get("awaiting_email", False):
-            users[user_id]["awaiting_email"] = True
-            save_data()
+        user_id = update.effective_user.id
+        user_data = await store.get(user_id) or UserRecord()
+        cost = config.rewards["claim_cost"]
+        if user_data.points < cost:
             await update.message.reply_text(
-                "🎁 Great! To claim your reward, please enter your Gmail address:"
+                f"❌ You need at least {cost} points to claim a reward!\n"
+                f"Current points: {user_data.points}\n"
+                f"Points needed: {cost - user_data.points}"
             )
             return
 
-        email = update.message.text
-        if not is_valid_email(email):
-            await update.message.reply_text(
-                "❌ Invalid email format! Please enter a valid Gmail address."
-            )
-            return
+        # Nothing is stored until the claim is confirmed. The price is fixed
+        # now, so a config reload cannot change what the user confirms.
+        conversations.begin(user_id, "awaiting_email", cost=cost)
+        await update.message.reply_text(
+            "🎁 Great! To claim your reward, please enter your Gmail address:",
+            reply_markup=replies.cancel_keyboard
+        )
 
-        users[user_id]["points"] -= 100
-        users[user_id]["email"] = email
-        users[user_id]["awaiting_email"] = False
-        users[user_id]["rewards_claimed"] = users[user_id].get("rewards_claimed", 0) + 1
-        save_data()
+    except Exception as e:
+        logger.error(f"Error in claim_reward: {str(e)}")
+        await update.message.reply_text("❌ An error occurred. Please try again.")
 
-        user_name = update.effective_user.first_name
-        user_link = f"[{user_name}](tg://user?id={user_id})"
-
-        # Notify admin
-        admin_message = (
-            f"🎁 New Reward Claim!\n\n"
-            f"User: {user_link}\n"
-            f"Email: {email}\n"
-            f"Total Claims: {users[user_id]['rewards_claimed']}\n"
-            f"Remaining Points: {users[user_id]['points']}"
+@conversations.on("awaiting_email")
+async def receive_claim_email(update: Update, context: CallbackContext, data):
+    email = update.message.text.strip()
+    if not is_valid_email(email):
+        await update.message.reply_text(
+            "❌ Invalid email format! Please enter a valid Gmail address."
         )
+        return
 
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=admin_message,
-                parse_mode='Markdown'
-            )
-        except Exception as e:
-            logger.error(f"Failed to notify admin: {str(e)}")
+    conversations.move(update.effective_user.id, "confirm", email=email)
+    await update.message.reply_text(
+        f"📧 Email: {email}\n\n"
+        f"Spend {data['cost']} points to claim a reward to this address?",
+        reply_markup=replies.confirm_keyboard
+    )
+
+@conversations.on("confirm")
+async def confirm_claim(update: Update, context: CallbackContext, data):
+    if update.message.text != "✅ Confirm":
+        await update.message.reply_text("Tap ✅ Confirm to claim your reward or ❌ Cancel to stop.")
+        return
 
+    user_id = update.effective_user.id
+    email = data["email"]
+    cost = data["cost"]
+    conversations.end(user_id)
+
+    # The balance is checked again under the user's lock, so a double tap
+    # cannot spend the same points twice.
+    async with store.transaction(user_id) as tx:
+        user_data = tx.get(user_id) or UserRecord()
+        if user_data.banned:
+            outcome = "banned"
+        elif user_data.points < cost:
+            outcome = "insufficient"
+        else:
+            user_data.points -= cost
+            user_data.email = email
+            # Set by versions that kept this flow in the store
+            user_data.awaiting_email = False
+            user_data.rewards_claimed += 1
+            outcome = "claimed"
+
+    reply_markup = replies.main_menu(user_id)
+    if outcome == "banned":
+        await update.message.reply_text("🚫 You are banned from using this bot.")
+        return
+
+    if outcome == "insufficient":
         await update.message.reply_text(
-            "✅ Reward claimed successfully!\n"
-            f"Remaining points: {users[user_id]['points']}\n"
-            "An admin will contact you soon."
+            f"❌ You need at least {cost} points to claim a reward!\n"
+            f"Current points: {user_data.points}",
+            reply_markup=reply_markup
         )
+        return
 
-    except Exception as e:
-        logger.error(f"Error in claim_reward: {str(e)}")
-        await update.message.reply_text("❌ An error occurred. Please try again.")
+    user_name = update.effective_user.first_name
+    user_link = f"[{user_name}](tg://user?id={user_id})"
+
+    # Notify admins
+    admin_message = (
+        f"🎁 New Reward Claim!\n\n"
+        f"User: {user_link}\n"
+        f"Email: {email}\n"
+        f"Total Claims: {user_data.rewards_claimed}\n"
+        f"Remaining Points: {user_data.points}"
+    )
+    notify_admins(admin_message, parse_mode='Markdown')
+
+    await update.message.reply_text(
+        "✅ Reward claimed successfully!\n"
+        f"Remaining points: {user_data.points}\n"
+        "An admin will contact you soon.",
+        reply_markup=reply_markup
+    )
+
+# Rendered top-10 text, rebuilt only when the store reports a leaderboard change
+leaderboard_snapshot = {"version": None, "text": None}
+
+async def render_leaderboard(context: CallbackContext):
+    version = store.leaderboard_version
+    if version is not None and leaderboard_snapshot["version"] == version:
+        return leaderboard_snapshot["text"]
+
+    sorted_users = await store.top_referrers(10)
+    message = "🏆 Top Referrers:\n\n"
+
+    for user_id, data in sorted_users:
+        if data.name and not name_cache.get(user_id):
+            name_cache.set(user_id, data.name)
+    names = await resolve_names(context, [user_id for user_id, _ in sorted_users])
+
+    for i, (user_id, data) in enumerate(sorted_users, 1):
+        name = names.get(user_id) or f"User{str(user_id)[:4]}"
+        message += f"{i}. {name}: {data.referrals} referrals | {data.points} points\n"
+
+    if len(sorted_users) == 0:
+        message += "No users yet!"
+
+    leaderboard_snapshot["version"] = version
+    leaderboard_snapshot["text"] = message
+    return message
 
 async def leaderboard(update: Update, context: CallbackContext):
     try:
-        sorted_users = sorted(users.items(), key=lambda x: x[1]['referrals'], reverse=True)
-        message = "🏆 Top Referrers:\n\n"
-        
-        for i, (user_id, data) in enumerate(sorted_users[:10], 1):
-            try:
-                user = await context.bot.get_chat(user_id)
-                name = user.first_name
-            except:
-                name = f"User{user_id[:4]}"
-            message += f"{i}. {name}: {data['referrals']} referrals | {data['points']} points\n"
+        message = await render_leaderboard(context)
 
-        if len(sorted_users) == 0:
-            message += "No users yet!"
+        rank = await store.referral_rank(update.effective_user.id)
+        if rank is not None:
+            message += f"\n📍 Your position: #{rank}"
 
         await update.message.reply_text(message)
     except Exception as e:
@@ -501,94 +1125,198 @@ async def leaderboard(update: Update, context: CallbackContext):
 # Rest of your existing functions (my_points, claim_reward, leaderboard, help_command)
 # ... (keep them as they were)
 
+def task_completed_text(task, user):
+    return (
+        f"🎉 Congratulations! You've completed the {task.title} task.\n"
+        f"{task.points} points have been added to your account!\n"
+        f"Current balance: {user.points} points"
+    )
+
+def task_link(task):
+    """Handler for a link task's link being sent back."""
+    async def link(update: Update, context: CallbackContext):
+        awarded, user = await complete_task(store, update.effective_user.id, task)
+        if awarded:
+            await update.message.reply_text(task_completed_text(task, user))
+        else:
+            await update.message.reply_text(f"✅ You've already completed the {task.title} task.")
+    return link
+
+def task_prompt(task):
+    async def prompt(update: Update, context: CallbackContext):
+        user = await store.get(update.effective_user.id)
+        if user is not None and user.has_completed(task.bit):
+            await update.message.reply_text(f"✅ You've already completed the {task.title} task.")
+            return
+        text, reply_markup = replies.task_prompts[task.id]
+        await update.message.reply_text(text, reply_markup=reply_markup)
+    return prompt
+
+async def verify_task(update: Update, context: CallbackContext):
+    """The Verify/Done button under a channel or callback task."""
+    query = update.callback_query
+    user_id = query.from_user.id
+    task = task_routes.registry.by_id.get(query.data.split(":", 1)[1])
+    if task is None or task.verify == "link":
+        await query.answer("This task is no longer available.")
+        return
+
+    if task.verify == "channel":
+        # Just joined is the common case here, so don't trust a cached "not a member"
+        membership_cache.pop((user_id, task.channel))
+        try:
+            is_member = await is_channel_member(context, task.channel, user_id)
+        except TelegramError as e:
+            logger.error(f"Error verifying task {task.id}: {str(e)}")
+            await query.answer("❌ Could not check right now. Please try again.")
+            return
+        if not is_member:
+            await query.answer(f"❌ Join {task.channel} first, then tap Verify.", show_alert=True)
+            return
+
+    awarded, user = await complete_task(store, user_id, task)
+    await query.answer()
+    if awarded:
+        await query.edit_message_text(task_completed_text(task, user))
+    else:
+        await query.edit_message_text(f"✅ You've already completed the {task.title} task.")
+
+async def join_channels(update: Update, context: CallbackContext):
+    await update.message.reply_text(replies.join_info)
+
+async def check_again(update: Update, context: CallbackContext):
+    # Tapped right after joining, so ask again wherever we cached "not a member"
+    user_id = update.effective_user.id
+    for channel in config.channels:
+        if membership_cache.get((user_id, channel)) is False:
+            membership_cache.pop((user_id, channel))
+    if await check_channel_membership(update, context):
+        await start(update, context)
+    else:
+        await update.message.reply_text(
+            "❌ You haven't joined all required channels yet.\n"
+            "Please join and try again."
+        )
+
+def reply_with(text):
+    async def reply(update: Update, context: CallbackContext):
+        await update.message.reply_text(text)
+    return reply
+
+# Text routing: menu buttons are looked up in a dict, task links are matched
+# by one combined regex (see tasks.py). Fixed routes are built once at import,
+# the routes of configured tasks whenever the config is (re)loaded.
+class Route:
+    __slots__ = ("handler", "admin_only", "name")
+
+    def __init__(self, handler, admin_only=False, name=None):
+        self.handler = handler
+        self.admin_only = admin_only
+        # Label for the route's metrics
+        self.name = f"text:{name or handler.__name__}"
+
+TEXT_ROUTES = {
+    "✅ Join Channels": Route(join_channels),
+    "🔄 Check Again": Route(check_again),
+    "👥 Refer & Earn": Route(refer_earn),
+    "💰 My Points": Route(my_points),
+    "🎁 Claim Reward": Route(claim_reward),
+    "🏆 Leaderboard": Route(leaderboard),
+    "📅 Daily Reward": Route(check_daily_reward),
+    "ℹ️ Help": Route(help_command),
+    "🔙 Back": Route(start),
+    "🔐 Admin Panel": Route(admin_panel, admin_only=True),
+    "📢 Broadcast": Route(reply_with("Use /broadcast <message>"), admin_only=True, name="broadcast_usage"),
+    "🚫 Ban User": Route(reply_with("Use /ban <user_id>, or send a file of user IDs with the caption /ban"),
+                        admin_only=True, name="ban_usage"),
+    "✅ Unban User": Route(reply_with("Use /unban <user_id>, or send a file of user IDs with the caption /unban"),
+                          admin_only=True, name="unban_usage"),
+    "💰 Edit Points": Route(reply_with("Use /points <user_id> <points>, or send a CSV of user_id,points "
+                                       "with the caption /points"), admin_only=True, name="points_usage"),
+    "📊 User Stats": Route(user_stats, admin_only=True),
+    "👥 View Users": Route(view_users, admin_only=True),
+}
+
+class TaskRoutes:
+    """Routes of the configured tasks: each task's menu button, and its link sent back as proof."""
+
+    def __init__(self, tasks):
+        self.registry = TaskRegistry(tasks)
+        self.buttons = {task.button: Route(task_prompt(task), name=f"{task.id}_task") for task in tasks}
+        self.links = {task.id: Route(task_link(task), name=f"{task.id}_link")
+                      for task in tasks if task.verify == "link"}
+
+task_routes = TaskRoutes(config.tasks)
+
+def find_route(text):
+    route = TEXT_ROUTES.get(text) or task_routes.buttons.get(text)
+    if route is None:
+        task = task_routes.registry.match_link(text)
+        if task is not None:
+            route = task_routes.links[task.id]
+    return route
+
+def apply_config(new_config):
+    """Make ``new_config`` current along with everything built from it.
+
+    The keyboards, texts and task routes are built first and then swapped
+    in by one assignment with no await in between, so no update ever sees a
+    mix of old and new. Handlers already running finish with the objects
+    they started with.
+    """
+    global config, replies, task_routes
+    new_replies = StaticReplies(new_config)
+    if replies.bot_username is not None:
+        new_replies.bot_username = replies.bot_username
+        new_replies.referral_link_prefix = replies.referral_link_prefix
+    new_task_routes = TaskRoutes(new_config.tasks)
+    config, replies, task_routes = new_config, new_replies, new_task_routes
+
+config_watcher = ConfigWatcher(CONFIG_FILE, apply_config)
+
+async def reload_config(update: Update, context: CallbackContext):
+    if not config.is_admin(update.effective_user.id):
+        return
+    try:
+        new_config = load_config(CONFIG_FILE)
+    except (OSError, ValueError) as e:
+        await update.message.reply_text(f"❌ Config not reloaded: {str(e)}")
+        return
+    apply_config(new_config)
+    await update.message.reply_text(
+        f"✅ Config reloaded: {len(new_config.channels)} channels, "
+        f"{len(new_config.admins)} admins, {len(new_config.tasks)} tasks",
+        reply_markup=replies.main_menu(update.effective_user.id)
+    )
+
 async def handle_text(update: Update, context: CallbackContext):
     try:
         text = update.message.text
-        user_id = str(update.effective_user.id)
-
-        # Check if user is banned
-        if users.get(user_id, {}).get("banned", False):
-            await update.message.reply_text("🚫 You are banned from using this bot.")
+        route = find_route(text)
+        user_id = update.effective_user.id
+
+        # A flow in progress takes free text; a menu button leaves the flow
+        state = conversations.state(user_id)
+        if state is not None:
+            if text == "❌ Cancel":
+                conversations.end(user_id)
+                await update.message.reply_text("Cancelled.", reply_markup=replies.main_menu(user_id))
+                return
+            if route is None:
+                with track(f"conversation:{state}"):
+                    await conversations.handle(update, context)
+                return
+            conversations.end(user_id)
+
+        if route is None:
             return
 
-        # Handle Midas RWA referral verification
-        if "MidasRWA_bot/app?startapp=ref_" in text:
-            if not users.get(user_id, {}).get("midas_referral_clicked", False):
-                users[user_id] = users.get(user_id, {"points": 0})
-                users[user_id]["midas_referral_clicked"] = True
-                save_data()
-                await update.message.reply_text(
-                    "✅ First click on Midas RWA referral registered!\n"
-                    "Please click the link again to confirm your participation."
-                )
-            else:
-                users[user_id]["points"] = users[user_id].get("points", 0) + 15
-                users[user_id]["midas_referral_completed"] = True
-                save_data()
-                await update.message.reply_text(
-                    "🎉 Congratulations! You've completed the Midas RWA task.\n"
-                    "15 points have been added to your account!"
-                )
+        if route.admin_only and not config.is_admin(user_id):
             return
 
-        # Handle menu options
-        if text == "✅ Join Channels":
-            channels_text = "\n".join([f"{i+1}➡️ {channel}" for i, channel in enumerate(REQUIRED_CHANNELS)])
-            await update.message.reply_text(
-                "🌟 Welcome to our Earning Community! 🌟\n\n"
-                "Join our official channels to:\n"
-                "• Get instant earning updates\n"
-                "• Access exclusive reward opportunities\n"
-                "• Stay informed about special bonuses\n\n"
-                "Click '🔄 Check Again' after joining to activate your rewards!\n\n"
-                f"Join now:\n{channels_text}"
-            )
-        elif text == "🔄 Check Again":
-            if await check_channel_membership(update, context):
-                await start(update, context)
-            else:
-                await update.message.reply_text(
-                    "❌ You haven't joined all required channels yet.\n"
-                    "Please join and try again."
-                )
-        elif text == "👥 Refer & Earn":
-            await refer_earn(update, context)
-        elif text == "💰 My Points":
-            await my_points(update, context)
-        elif text == "🎁 Claim Reward":
-            await claim_reward(update, context)
-        elif text == "🏆 Leaderboard":
-            await leaderboard(update, context)
-        elif text == "📅 Daily Reward":
-            await check_daily_reward(update, context)
-        elif text == "🔥 Midas RWA Task":
-            await update.message.reply_text(
-                "🎯 Complete Midas RWA Task:\n\n"
-                "1. Click this link:\n"
-                "https://t.me/MidasRWA_bot/app?startapp=ref_326f2187-d1cb-43ab-bb7f-5ae74e3c93d6\n\n"
-                "2. Complete the registration\n"
-                "3. Send the link back here to verify\n\n"
-                "Earn 15 points upon completion! 🎁"
-            )
-        elif text == "ℹ️ Help":
-            await help_command(update, context)
-        elif text == "🔐 Admin Panel" and str(user_id) == str(ADMIN_ID):
-            await admin_panel(update, context)
-        elif text in ["📢 Broadcast", "🚫 Ban User", "✅ Unban User", "💰 Edit Points", "📊 User Stats", "👥 View Users"] and str(user_id) == str(ADMIN_ID):
-            if text == "📢 Broadcast":
-                await update.message.reply_text("Use /broadcast <message>")
-            elif text == "🚫 Ban User":
-                await update.message.reply_text("Use /ban <user_id>")
-            elif text == "✅ Unban User":
-                await update.message.reply_text("Use /unban <user_id>")
-            elif text == "💰 Edit Points":
-                await update.message.reply_text("Use /points <user_id> <points>")
-            elif text == "📊 User Stats":
-                await user_stats(update, context)
-            elif text == "👥 View Users":
-                await view_users(update, context)
-        elif text == "🔙 Back":
-            await start(update, context)
+        # Banned users never get here, see gate()
+        with track(route.name):
+            await route.handler(update, context)
 
     except Exception as e:
         logger.error(f"Error in handle_text: {str(e)}")
@@ -598,27 +1326,140 @@ async def error_handler(update: Update, context: CallbackContext) -> None:
     logger.error(f"Exception while handling an update: {context.error}")
     traceback.print_exc()
 
+def build_application(webhook=False, request=None):
+    init_store()
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(load_data)
+        .post_shutdown(save_data)
+        # Safe because balance changes go through per-user store transactions
+        .concurrent_updates(True)
+    )
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    # Bot API calls are timed per method; a custom transport (e.g. the stub
+    # used by the benchmarks) is wrapped the same way as the default one
+    builder = builder.request(InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256)))
+    if webhook:
+        # Updates are pushed by the embedded web server instead of fetched
+        builder = builder.updater(None)
+    else:
+        builder = builder.get_updates_request(InstrumentedRequest(request or HTTPXRequest()))
+    app = builder.build()
+
+    REGISTRY.gauge("bot_update_queue_size", "Updates received and not yet picked up by a handler",
+                   app.update_queue.qsize)
+
+    # Ban and flood checks ahead of every other handler
+    app.add_handler(TypeHandler(Update, instrument("gate", gate)), group=-1)
+
+    # Add handlers
+    app.add_handler(CommandHandler("start", instrument("start", start)))
+    app.add_handler(CommandHandler("admin", instrument("admin", admin_panel)))
+    app.add_handler(CommandHandler("broadcast", instrument("broadcast", broadcast_message)))
+    app.add_handler(CommandHandler("ban", instrument("ban", ban_user)))
+    app.add_handler(CommandHandler("unban", instrument("unban", unban_user)))
+    app.add_handler(CommandHandler("points", instrument("points", edit_points)))
+    app.add_handler(CommandHandler("help", instrument("help", help_command)))
+    app.add_handler(CommandHandler("export_users", instrument("export_users", export_users)))
+    app.add_handler(CommandHandler("downline", instrument("downline", show_downline)))
+    app.add_handler(CommandHandler("suspicious", instrument("suspicious", suspicious_referrers)))
+    app.add_handler(CommandHandler("reload", instrument("reload", reload_config)))
+    app.add_handler(MessageHandler(filters.Document.ALL, instrument("bulk_update", bulk_update)))
+    app.add_handler(CallbackQueryHandler(instrument("users_page", view_users_page), pattern=r"^users:"))
+    app.add_handler(CallbackQueryHandler(instrument("verify_task", verify_task), pattern=r"^task:"))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument("text", handle_text)))
+    app.add_handler(ChatMemberHandler(instrument("chat_member", track_channel_member), ChatMemberHandler.CHAT_MEMBER))
+
+    # Runs after the handlers above, so replies are never delayed by it
+    app.add_handler(TypeHandler(Update, instrument("remember_user", remember_user)), group=1)
+
+    # Add error handler
+    app.add_error_handler(error_handler)
+    return app
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Telegram referral bot")
+    parser.add_argument(
+        "--mode", choices=["polling", "webhook"], default=os.getenv("BOT_MODE", "polling"),
+        help="how to receive updates (default: $BOT_MODE or polling)"
+    )
+    parser.add_argument("--webhook-url", default=os.getenv("WEBHOOK_URL"),
+                        help="public base URL to register with Telegram; omit to only listen locally")
+    parser.add_argument("--listen", default=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("WEBHOOK_PORT", "8443")))
+    parser.add_argument("--path", default=os.getenv("WEBHOOK_PATH", "/telegram"))
+    parser.add_argument("--secret-token", default=os.getenv("WEBHOOK_SECRET"),
+                        help="value Telegram sends in X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--max-connections", type=int, default=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")))
+    parser.add_argument("--shards", type=int, default=int(os.getenv("BOT_SHARDS", "1")),
+                        help="worker processes to spread users over (default: $BOT_SHARDS or 1); needs USER_STORE=sqlite")
+    parser.add_argument("--shard-worker", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def webhook_secret(args):
+    """The secret token webhook requests must carry: --secret-token, or a new random one."""
+    if args.secret_token:
+        return args.secret_token
+    secret_token = secrets.token_urlsafe(32)
+    if not args.webhook_url:
+        # Nothing is registered with Telegram, so whoever POSTs updates locally needs it
+        logger.info(f"No --secret-token given; local requests must send {SECRET_HEADER}: {secret_token}")
+    return secret_token
+
+def main_sharded(args):
+    """Front process of sharded mode: receive updates and route them to ``args.shards`` workers."""
+    if STORE_BACKEND != "sqlite":
+        logger.error("Sharded mode needs the shared SQLite store; set USER_STORE=sqlite")
+        sys.exit(1)
+    # Migrate and upgrade the schema once, before several processes open the database
+    prepare_store()
+    async def upgrade():
+        db = SQLiteStore(DB_FILE)
+        await db.open()
+        await db.close()
+    asyncio.run(upgrade())
+
+    base_url = {}
+    if BOT_API_URL:
+        base_url = {"base_url": f"{BOT_API_URL}/bot", "base_file_url": f"{BOT_API_URL}/file/bot"}
+    bot = Bot(TOKEN, get_updates_request=HTTPXRequest(), **base_url)
+    supervisor = ShardSupervisor(args.shards, [sys.executable, os.path.abspath(__file__), "--shard-worker"])
+    webhook = None
+    if args.mode == "webhook":
+        webhook = {
+            "listen": args.listen, "port": args.port, "path": args.path,
+            "secret_token": webhook_secret(args),
+            "webhook_url": args.webhook_url, "max_connections": args.max_connections,
+        }
+    logger.info(f"Starting bot ({args.mode}, {args.shards} shards)...")
+    asyncio.run(run_sharded(bot, supervisor, webhook))
+
 def main():
     try:
-        # Create application
-        app = Application.builder().token(TOKEN).build()
-
-        # Add handlers
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("admin", admin_panel))
-        app.add_handler(CommandHandler("broadcast", broadcast_message))
-        app.add_handler(CommandHandler("ban", ban_user))
-        app.add_handler(CommandHandler("unban", unban_user))
-        app.add_handler(CommandHandler("points", edit_points))
-        app.add_handler(CommandHandler("help", help_command))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-
-        # Add error handler
-        app.add_error_handler(error_handler)
+        args = parse_args()
+        if args.shard_worker:
+            # Updates arrive on stdin from the front process
+            logger.info(f"Starting shard {SHARD_INDEX} of {SHARD_COUNT}...")
+            asyncio.run(serve_shard(build_application(webhook=True)))
+            return
+        if args.shards > 1:
+            main_sharded(args)
+            return
+
+        app = build_application(webhook=args.mode == "webhook")
 
         # Start the bot
-        logger.info("Starting bot...")
-        app.run_polling()
+        logger.info(f"Starting bot ({args.mode})...")
+        if args.mode == "webhook":
+            asyncio.run(run_webhook(
+                app, args.listen, args.port, args.path, webhook_secret(args),
+                webhook_url=args.webhook_url, max_connections=args.max_connections
+            ))
+        else:
+            # chat_member updates are not sent unless requested explicitly
+            app.run_polling(allowed_updates=Update.ALL_TYPES)
 
     except Exception as e:
         logger.error(f"Error in main: {str(e)}")
@@ -0,0 +1,260 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from models import parse_user_id
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket for Telegram's global send limit plus a minimum interval per chat.
+
+    ``pause`` stops every sender for a while, which is how a RetryAfter from the
+    Bot API (a flood wait that applies to the whole bot) is honoured.
+    """
+
+    def __init__(self, rate=30.0, per_chat_interval=1.0):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self._chat_next = {}
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id=None):
+        if chat_id is not None:
+            await self._acquire_chat(chat_id)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _acquire_chat(self, chat_id):
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.per_chat_interval
+        if len(self._chat_next) > 10_000:
+            self._chat_next = {chat: t for chat, t in self._chat_next.items() if t > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class Broadcaster:
+    """Sends one message to every user as a background task.
+
+    Users are walked in user_id order in batches. After each batch the cursor
+    (last user_id handled) and the counters are written to ``state_path``, so a
+    broadcast interrupted by a restart resumes where it stopped; at worst the
+    last unfinished batch is sent twice. Users that blocked the bot are marked
+    ``blocked`` in the store and skipped until they send /start again.
+
+    Only one broadcast runs at a time across every process sharing the store:
+    a run holds the store's "broadcast" lease for ``owner`` and renews it after
+    every batch. If the process dies, the lease lapses after LEASE_TTL unless
+    the process is back by then to resume, so a shard that is never restarted
+    cannot block broadcasts for good.
+
+    While a broadcast runs, ``limiter`` is raised to ``rate`` (if higher), so
+    the one process sending it can use the bot-wide budget that is otherwise
+    split between processes.
+    """
+
+    PROGRESS_INTERVAL = 5.0
+    MAX_ATTEMPTS = 3
+    LEASE = "broadcast"
+    LEASE_TTL = 10 * 60
+
+    def __init__(self, store, state_path, limiter, owner="main", rate=None, workers=20, batch_size=200):
+        self.store = store
+        self.state_path = state_path
+        self.owner = owner
+        self.limiter = limiter
+        self.rate = rate
+        self.workers = workers
+        self.batch_size = batch_size
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error reading broadcast state: {str(e)}")
+            return None
+
+    def _save_state(self, state):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _clear_state(self):
+        try:
+            os.remove(self.state_path)
+        except FileNotFoundError:
+            pass
+
+    async def start(self, application, message, admin_chat_id):
+        """Start a new broadcast; returns False if one is already running here or elsewhere."""
+        if self.running or not await self.store.acquire_lease(self.LEASE, self.owner, self.LEASE_TTL):
+            return False
+        state = {
+            "message": message,
+            "admin_chat_id": admin_chat_id,
+            "cursor": None,
+            "total": await self.store.count(),
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0,
+            "status_message_id": None,
+        }
+        self._save_state(state)
+        self._task = application.create_task(self._run(application.bot, state))
+        return True
+
+    async def resume(self, application):
+        """Continue a broadcast left unfinished by a previous process, if any."""
+        if self.running:
+            return False
+        state = self.load_state()
+        if state is None:
+            # Nothing to finish, so a lease still held under our name is stale
+            await self.store.release_lease(self.LEASE, self.owner)
+            return False
+        if not await self.store.acquire_lease(self.LEASE, self.owner, self.LEASE_TTL):
+            logger.warning(f"Not resuming broadcast from {self.state_path}: another one is running")
+            return False
+        if state["cursor"] is not None:
+            # Saved by a version that used string user IDs
+            state["cursor"] = parse_user_id(state["cursor"])
+        logger.info(f"Resuming broadcast after user {state['cursor']}")
+        self._task = application.create_task(self._run(application.bot, state))
+        return True
+
+    async def _run(self, bot, state):
+        started = time.monotonic()
+        done_at_start = state["sent"] + state["failed"] + state["blocked"]
+        last_report = 0.0
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def send(user_id):
+            async with semaphore:
+                state[await self._deliver(bot, user_id, state["message"])] += 1
+
+        base_rate = self.limiter.rate
+        if self.rate is not None:
+            self.limiter.rate = max(base_rate, self.rate)
+        try:
+            if state["status_message_id"] is None:
+                await self._report(bot, state, "📢 Broadcast started...")
+            batch = []
+            async for user_id, record in self.store.iter_users(after=state["cursor"]):
+                if record.blocked:
+                    continue
+                batch.append(user_id)
+                if len(batch) < self.batch_size:
+                    continue
+                await asyncio.gather(*(send(user_id) for user_id in batch))
+                state["cursor"] = batch[-1]
+                batch = []
+                self._save_state(state)
+                if not await self.store.acquire_lease(self.LEASE, self.owner, self.LEASE_TTL):
+                    # Stalled past the TTL and another process started a broadcast meanwhile
+                    logger.error(f"Lost the broadcast lease; pausing until restart after user {state['cursor']}")
+                    return
+
+                now = time.monotonic()
+                if now - last_report >= self.PROGRESS_INTERVAL:
+                    last_report = now
+                    await self._report(bot, state, self._progress_text(state, started, done_at_start))
+
+            if batch:
+                await asyncio.gather(*(send(user_id) for user_id in batch))
+                state["cursor"] = batch[-1]
+
+            self._clear_state()
+            await self.store.release_lease(self.LEASE, self.owner)
+            await self._report(
+                bot, state,
+                f"✅ Broadcast sent to {state['sent']} users\n"
+                f"❌ Failed: {state['failed']} | 🚫 Blocked: {state['blocked']}"
+            )
+        except asyncio.CancelledError:
+            # Shutdown: the saved cursor lets the next process resume.
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast stopped: {str(e)}")
+        finally:
+            self.limiter.rate = base_rate
+
+    async def _deliver(self, bot, user_id, message):
+        for attempt in range(self.MAX_ATTEMPTS):
+            await self.limiter.acquire(user_id)
+            try:
+                await bot.send_message(chat_id=user_id, text=message)
+                return "sent"
+            except RetryAfter as e:
+                self.limiter.pause(e.retry_after)
+            except Forbidden as e:
+                logger.info(f"Dropping {user_id} from broadcasts: {str(e)}")
+                async with self.store.transaction(user_id) as tx:
+                    record = tx.get(user_id)
+                    if record is not None:
+                        record.blocked = True
+                return "blocked"
+            except BadRequest as e:
+                # Usually the message itself (too long, bad entities), so retrying cannot help
+                logger.error(f"Failed to send broadcast to {user_id}: {str(e)}")
+                return "failed"
+            except TelegramError as e:
+                logger.error(f"Failed to send broadcast to {user_id}: {str(e)}")
+                await asyncio.sleep(2 ** attempt)
+        return "failed"
+
+    def _progress_text(self, state, started, done_at_start):
+        done = state["sent"] + state["failed"] + state["blocked"]
+        elapsed = max(time.monotonic() - started, 1e-6)
+        rate = (done - done_at_start) / elapsed
+        remaining = max(state["total"] - done, 0)
+        eta = f"{int(remaining / rate // 60)}m {int(remaining / rate % 60)}s" if rate > 0 else "unknown"
+        percent = 100 * done // state["total"] if state["total"] else 100
+        return (
+            f"📢 Broadcasting... {done}/{state['total']} ({percent}%)\n"
+            f"✅ Sent: {state['sent']} | ❌ Failed: {state['failed']} | 🚫 Blocked: {state['blocked']}\n"
+            f"⚡ {rate:.1f} msg/s | ⏳ ETA: {eta}"
+        )
+
+    async def _report(self, bot, state, text):
+        chat_id = state["admin_chat_id"]
+        try:
+            if state["status_message_id"] is None:
+                status = await bot.send_message(chat_id=chat_id, text=text)
+                state["status_message_id"] = status.message_id
+            else:
+                await self.limiter.acquire(chat_id)
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=state["status_message_id"])
+        except TelegramError as e:
+            logger.error(f"Could not report broadcast progress: {str(e)}")
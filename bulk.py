@@ -0,0 +1,113 @@
+import csv
+import io
+from collections import Counter
+
+from models import INT64_MAX, INT64_MIN, parse_user_id
+
+# Admin operations that take an uploaded file, by the command given as its caption,
+# and whether each row carries a points value
+OPERATIONS = {"points": True, "ban": False, "unban": False}
+
+# Per-row results; rows that are still to be applied have none yet
+APPLIED = "ok"
+UNCHANGED = "unchanged"
+NOT_FOUND = "user not found"
+DUPLICATE = "duplicate, skipped"
+BAD_USER_ID = "invalid user id"
+BAD_POINTS = "invalid points"
+POINTS_OUT_OF_RANGE = "points out of range"
+
+# Column names that mark the first line of an upload as a header
+HEADER_COLUMNS = ("user_id", "points")
+
+
+class BulkRow:
+    """One line of an uploaded file: ``points`` is (is_delta, amount) for /points, else None."""
+
+    __slots__ = ("line", "user_id", "points", "result")
+
+    def __init__(self, line, user_id, points=None, result=None):
+        self.line = line
+        self.user_id = user_id
+        self.points = points
+        self.result = result
+
+
+def parse_operation(caption):
+    """Return the operation named by a caption like "/ban" or "/points@MyBot", or None."""
+    if not caption:
+        return None
+    command = caption.split()[0].lstrip("/").split("@")[0].lower()
+    return command if command in OPERATIONS else None
+
+
+def parse_points(value):
+    """"+50" and "-10" change the balance by that much; a bare number sets it.
+
+    Returns None for anything else, including amounts that do not fit in int64.
+    """
+    value = value.strip()
+    is_delta = value[:1] in ("+", "-")
+    try:
+        amount = int(value)
+    except ValueError:
+        return None
+    return (is_delta, amount) if INT64_MIN <= amount <= INT64_MAX else None
+
+
+def parse_rows(data, with_points):
+    """Parse an uploaded CSV or plain list of user IDs (one per line).
+
+    The first non-empty line is a header if it names a ``user_id`` or
+    ``points`` column, and those columns are then used, so a /export file can be edited
+    and uploaded as is. Otherwise the ID is the first column and the points
+    the second.
+    Raises UnicodeDecodeError for a file that is not UTF-8 text.
+    """
+    reader = csv.reader(io.StringIO(data.decode("utf-8-sig")))
+    id_column, points_column = 0, 1
+    rows = []
+    seen = set()
+    first = True
+    for line, cells in enumerate(reader, start=1):
+        if not cells or not any(cell.strip() for cell in cells):
+            continue
+        if first:
+            first = False
+            header = [cell.strip().lower() for cell in cells]
+            if any(name in header for name in HEADER_COLUMNS):
+                id_column = header.index("user_id") if "user_id" in header else 0
+                points_column = header.index("points") if "points" in header else 1
+                continue
+
+        user_id = parse_user_id(cells[id_column]) if id_column < len(cells) else None
+        if user_id is None:
+            rows.append(BulkRow(line, None, result=BAD_USER_ID))
+            continue
+        points = None
+        if with_points:
+            points = parse_points(cells[points_column]) if points_column < len(cells) else None
+            if points is None:
+                rows.append(BulkRow(line, user_id, result=BAD_POINTS))
+                continue
+        if user_id in seen:
+            rows.append(BulkRow(line, user_id, points, result=DUPLICATE))
+            continue
+        seen.add(user_id)
+        rows.append(BulkRow(line, user_id, points))
+    return rows
+
+
+def summarize(rows):
+    """One line per result with its row count, most common first."""
+    counts = Counter(row.result for row in rows)
+    return "\n".join(f"• {result}: {count}" for result, count in counts.most_common())
+
+
+def write_report(rows):
+    """Return the per-row results as CSV bytes."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["line", "user_id", "result"])
+    writer.writerows((row.line, row.user_id if row.user_id is not None else "", row.result) for row in rows)
+    return out.getvalue().encode("utf-8")
@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import re
+
+from tasks import compile_link_matcher
+
+logger = logging.getLogger(__name__)
+
+# What the bot runs with when there is no config file; a file only needs the
+# sections it changes. Format:
+#
+#   {
+#     "admins": [848533788],
+#     "channels": ["@fampayearningapp", "@grassnodepayairdrop"],
+#     "rewards": {"referrer": 10, "referred": 5, "daily": 5, "claim_cost": 100},
+#     "tasks": [{"id": "midas", "bit": 0, "verify": "link", "button": "🔥 Midas RWA Task",
+#                "title": "Midas RWA", "url": "https://t.me/...", "points": 15,
+#                "pattern": "MidasRWA_bot/app\\?startapp=ref_"}]
+#   }
+#
+# A task is completed once per user, and how is set by "verify":
+#   link      the user sends back a message matching "pattern", a regex without
+#             capturing groups (write (?:...) and scoped flags like (?i:...))
+#   channel   the user joins "channel" and taps Verify, which checks membership
+#   callback  the user taps Done under the task (nothing can be checked)
+# "bit" is where the completion is stored in each user record (0-62). It must
+# never be reused for another task, or users who did the old one count as
+# having done the new one; retire a task by removing it, not by renumbering.
+DEFAULTS = {
+    "admins": [848533788],
+    "channels": ["@fampayearningapp", "@grassnodepayairdrop"],
+    "rewards": {"referrer": 10, "referred": 5, "daily": 5, "claim_cost": 100},
+    "tasks": [
+        {
+            "id": "midas",
+            "bit": 0,
+            "verify": "link",
+            "button": "🔥 Midas RWA Task",
+            "title": "Midas RWA",
+            "url": "https://t.me/MidasRWA_bot/app?startapp=ref_326f2187-d1cb-43ab-bb7f-5ae74e3c93d6",
+            "pattern": r"MidasRWA_bot/app\?startapp=ref_",
+            "points": 15,
+        },
+    ],
+}
+
+# Task fields each verification method needs on top of id, bit, verify, button, title, url and points
+VERIFY_FIELDS = {"link": ("pattern",), "channel": ("channel",), "callback": ()}
+MAX_TASK_BIT = 62
+
+
+class Task:
+    __slots__ = ("id", "bit", "verify", "button", "title", "url", "points", "pattern", "channel")
+
+    def __init__(self, id, bit, verify, button, title, url, points, pattern=None, channel=None):
+        self.id = id
+        self.bit = bit
+        self.verify = verify
+        self.button = button
+        self.title = title
+        self.url = url
+        self.points = points
+        self.pattern = pattern
+        self.channel = channel
+
+    @classmethod
+    def from_dict(cls, entry):
+        if not isinstance(entry, dict):
+            raise ValueError(f"tasks must be objects: {entry!r}")
+        name = entry.get("id")
+        verify = entry.get("verify")
+        if not isinstance(verify, str) or verify not in VERIFY_FIELDS:
+            raise ValueError(f"task {name!r} verify must be one of {', '.join(VERIFY_FIELDS)}")
+        required = {"id", "bit", "verify", "button", "title", "url", "points", *VERIFY_FIELDS[verify]}
+        if entry.keys() != required:
+            raise ValueError(
+                f"task {name!r} with verify {verify!r} needs exactly the fields {', '.join(sorted(required))}"
+            )
+        task = cls(**entry)
+        if not isinstance(task.id, str) or not re.fullmatch(r"[\w-]{1,32}", task.id):
+            raise ValueError(f"task ID {task.id!r} must be up to 32 letters, digits, _ or -")
+        if not isinstance(task.bit, int) or not 0 <= task.bit <= MAX_TASK_BIT:
+            raise ValueError(f"task {task.id!r} bit must be between 0 and {MAX_TASK_BIT}")
+        for field in ("button", "title", "url"):
+            if not isinstance(getattr(task, field), str) or not getattr(task, field):
+                raise ValueError(f"task {task.id!r} {field} must be non-empty text")
+        if not isinstance(task.points, int) or task.points < 0:
+            raise ValueError(f"task {task.id!r} points must be a whole number")
+        if verify == "link":
+            if not isinstance(task.pattern, str):
+                raise ValueError(f"task {task.id!r} pattern must be a regex string")
+            try:
+                groups = re.compile(task.pattern).groups
+            except re.error as e:
+                raise ValueError(f"task {task.id!r} pattern is not a valid regex: {e}")
+            # Patterns are combined into one regex (see tasks.compile_link_matcher),
+            # where their own groups would clash and renumber
+            if groups:
+                raise ValueError(f"task {task.id!r} pattern must not capture; write (?:...) instead of (...)")
+        if verify == "channel" and not _is_channel(task.channel):
+            raise ValueError(f"task {task.id!r} channel must be a public channel username like @mychannel")
+        return task
+
+
+def _is_channel(value):
+    return isinstance(value, str) and re.fullmatch(r"@\w{4,}", value) is not None
+
+
+class BotConfig:
+    """One validated, read-only version of the config; a reload builds a new one."""
+
+    __slots__ = ("admins", "admin_ids", "channels", "rewards", "tasks")
+
+    def __init__(self, admins, channels, rewards, tasks):
+        self.admins = tuple(admins)
+        self.admin_ids = frozenset(admins)
+        self.channels = tuple(channels)
+        self.rewards = dict(rewards)
+        self.tasks = tuple(tasks)
+
+    @property
+    def primary_admin(self):
+        return self.admins[0]
+
+    def is_admin(self, user_id):
+        return user_id in self.admin_ids
+
+    @classmethod
+    def from_dict(cls, data):
+        """Validate ``data`` on top of DEFAULTS; raises ValueError naming the first problem."""
+        if not isinstance(data, dict):
+            raise ValueError("config must be a JSON object")
+        unknown = data.keys() - DEFAULTS.keys()
+        if unknown:
+            raise ValueError(f"unknown config sections: {', '.join(sorted(unknown))}")
+
+        admins = data.get("admins", DEFAULTS["admins"])
+        if not isinstance(admins, list) or not admins or \
+                not all(isinstance(admin, int) and admin > 0 for admin in admins):
+            raise ValueError("admins must be a non-empty list of user IDs")
+
+        channels = data.get("channels", DEFAULTS["channels"])
+        if not isinstance(channels, list) or not all(_is_channel(channel) for channel in channels):
+            raise ValueError("channels must be a list of public channel usernames like @mychannel")
+
+        if not isinstance(data.get("rewards", {}), dict):
+            raise ValueError("rewards must be an object")
+        rewards = dict(DEFAULTS["rewards"])
+        rewards.update(data.get("rewards", {}))
+        if rewards.keys() != DEFAULTS["rewards"].keys():
+            raise ValueError(f"rewards may only set {', '.join(DEFAULTS['rewards'])}")
+        if not all(isinstance(value, int) and value >= 0 for value in rewards.values()):
+            raise ValueError("rewards must be whole numbers of points")
+        if rewards["claim_cost"] <= 0:
+            raise ValueError("rewards.claim_cost must be positive")
+
+        if not isinstance(data.get("tasks", []), list):
+            raise ValueError("tasks must be a list")
+        tasks = [Task.from_dict(entry) for entry in data.get("tasks", DEFAULTS["tasks"])]
+        for field in ("id", "bit", "button"):
+            if len({getattr(task, field) for task in tasks}) != len(tasks):
+                raise ValueError(f"task {field}s must be unique")
+        compile_link_matcher(tasks)
+
+        return cls(admins, channels, rewards, tasks)
+
+
+def load_config(path):
+    """Read the config at ``path``, or the defaults if there is no such file."""
+    if not os.path.exists(path):
+        return BotConfig.from_dict({})
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{path} is not valid JSON: {e}")
+    return BotConfig.from_dict(data)
+
+
+class ConfigWatcher:
+    """Reloads the config when its file changes, detected by polling the file's mtime and size.
+
+    A stat per poll is all it costs while nothing changes. A file that fails
+    to load is reported and the running config stays in place, so a typo
+    never takes the bot down; it is retried once the file changes again.
+    """
+
+    def __init__(self, path, on_change):
+        self.path = path
+        self.on_change = on_change
+        self._signature = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self):
+        """Reload if the file changed since the last poll; returns True when a new config was applied."""
+        signature = self._stat()
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        try:
+            config = load_config(self.path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Not reloading {self.path}: {str(e)}")
+            return False
+        self.on_change(config)
+        logger.info(f"Reloaded config from {self.path}" if signature else f"{self.path} removed, using defaults")
+        return True
+
+    async def poll_job(self, context=None):
+        """``poll`` with the signature of a JobQueue callback."""
+        self.poll()
@@ -0,0 +1,54 @@
+from caches import TTLCache
+
+
+class Conversations:
+    """In-memory state of multi-step flows, one current step per user.
+
+    A flow moves a user through named states with ``begin``/``move`` and
+    finishes with ``end``; each state has a handler registered with
+    ``on``. Nothing is written to the user store until a flow completes, and
+    a flow the user abandons expires ``ttl`` seconds after its last step, so
+    its state never outlives it.
+    """
+
+    def __init__(self, ttl=10 * 60, maxsize=100_000):
+        self._states = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._handlers = {}
+
+    def on(self, state):
+        """Decorator registering ``handler(update, context, data)`` for messages sent in ``state``."""
+        def register(handler):
+            self._handlers[state] = handler
+            return handler
+        return register
+
+    def begin(self, user_id, state, **data):
+        self._states.set(user_id, (state, data))
+
+    def move(self, user_id, state, **data):
+        """Go to ``state``, keeping the data gathered so far plus ``data``; also restarts the expiry."""
+        current = self._states.get(user_id)
+        merged = dict(current[1]) if current is not None else {}
+        merged.update(data)
+        self._states.set(user_id, (state, merged))
+
+    def end(self, user_id):
+        self._states.pop(user_id)
+
+    def state(self, user_id):
+        current = self._states.get(user_id)
+        return current[0] if current is not None else None
+
+    def prune(self):
+        """Forget abandoned flows whose time is up; returns how many."""
+        return self._states.prune()
+
+    async def handle(self, update, context):
+        """Pass the message to the handler of the sender's current state; False if there is none."""
+        user_id = update.effective_user.id
+        current = self._states.get(user_id)
+        if current is None:
+            return False
+        state, data = current
+        await self._handlers[state](update, context, data)
+        return True
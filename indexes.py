@@ -0,0 +1,298 @@
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from operator import neg
+
+from sortedcontainers import SortedList
+
+from models import UserRecord, to_day
+
+
+class LeaderboardIndex:
+    """Users ordered by referrals (highest first), maintained incrementally.
+
+    Entries are kept in a ``SortedList`` of ``(-referrals, user_id)`` keys,
+    so an update is an O(log n) remove and insert instead of a full sort, and
+    the top N is a slice. ``version`` changes whenever the
+    visible top N (ordering or the points shown next to it) may have changed,
+    which lets callers cache a rendered leaderboard between changes.
+    """
+
+    def __init__(self, size=10):
+        self.size = size
+        self.version = 0
+        self._keys = SortedList()
+        self._referrals = {}
+        self._points = {}
+
+    def build(self, user_ids, referrals, points):
+        """Index parallel columns, e.g. from ``SnapshotUsers.columns``."""
+        # Column-wise so that a million users are indexed without a Python-level loop
+        self._referrals = dict(zip(user_ids, referrals))
+        self._points = dict(zip(user_ids, points))
+        self._keys = SortedList(zip(map(neg, referrals), user_ids))
+        self.version += 1
+
+    def update(self, user_id, referrals, points):
+        new_key = (-referrals, user_id)
+        old_referrals = self._referrals.get(user_id)
+        if old_referrals is not None:
+            old_key = (-old_referrals, user_id)
+            if old_key == new_key:
+                if self._points[user_id] != points:
+                    self._points[user_id] = points
+                    if self._position(new_key) < self.size:
+                        self.version += 1
+                return
+            was_visible = self._position(old_key) < self.size
+            self._keys.remove(old_key)
+        else:
+            was_visible = False
+
+        self._keys.add(new_key)
+        self._referrals[user_id] = referrals
+        self._points[user_id] = points
+        if was_visible or self._position(new_key) < self.size:
+            self.version += 1
+
+    def remove(self, user_id):
+        old_referrals = self._referrals.pop(user_id, None)
+        if old_referrals is not None:
+            del self._points[user_id]
+            key = (-old_referrals, user_id)
+            position = self._position(key)
+            self._keys.remove(key)
+            if position < self.size:
+                self.version += 1
+
+    def _position(self, key):
+        return self._keys.bisect_left(key)
+
+    def top(self, limit):
+        return [key[1] for key in self._keys.islice(0, limit)]
+
+    def rank(self, user_id):
+        """Return the 1-based position of ``user_id`` (ties share a rank), or None if unknown."""
+        referrals = self._referrals.get(user_id)
+        if referrals is None:
+            return None
+        return self._keys.bisect_left((-referrals,)) + 1
+
+
+class UserIdIndex:
+    """User IDs in ascending order, for keyset pagination without sorting per request."""
+
+    def __init__(self):
+        self._keys = []
+
+    def __len__(self):
+        return len(self._keys)
+
+    def build(self, user_ids):
+        self._keys = sorted(user_ids)
+
+    def add(self, user_id):
+        position = bisect_left(self._keys, user_id)
+        if position == len(self._keys) or self._keys[position] != user_id:
+            self._keys.insert(position, user_id)
+
+    def remove(self, user_id):
+        position = bisect_left(self._keys, user_id)
+        if position < len(self._keys) and self._keys[position] == user_id:
+            del self._keys[position]
+
+    def after(self, user_id, limit):
+        """Up to ``limit`` IDs following ``user_id`` (from the start if None)."""
+        start = 0 if user_id is None else bisect_right(self._keys, user_id)
+        return self._keys[start:start + limit]
+
+    def before(self, user_id, limit):
+        """Up to ``limit`` IDs preceding ``user_id``, in ascending order."""
+        end = bisect_left(self._keys, user_id)
+        return self._keys[max(0, end - limit):end]
+
+
+STAT_TOTALS = (
+    "total_users", "total_points", "banned_users", "blocked_users",
+    "total_referrals", "referred_users", "rewards_claimed",
+)
+
+
+# Columns StatsAggregator.build takes after the user_id column
+STAT_FIELDS = ("points", "referrals", "rewards_claimed", "flags", "last_daily_claim")
+
+
+def _contribution(record):
+    return (
+        1,
+        record.points,
+        int(record.banned),
+        int(record.blocked),
+        record.referrals,
+        int(record.has_been_referred),
+        record.rewards_claimed,
+    )
+
+
+class StatsAggregator:
+    """Running totals over all users plus a histogram of daily-reward claims per day.
+
+    ``update`` applies the difference between a user's old and new record, so
+    keeping the totals current costs O(1) per write and reading them is free.
+    A claim is counted when a user's ``last_daily_claim`` moves to a new day;
+    the histogram is keyed by day number (see ``models.to_day``).
+    """
+
+    def __init__(self):
+        self.totals = dict.fromkeys(STAT_TOTALS, 0)
+        self.daily_claims = Counter()
+
+    def build(self, user_ids, points, referrals, rewards_claimed, flags, last_claims, daily_claims=None):
+        """Sum up the user_id column and the STAT_FIELDS columns, e.g. from ``SnapshotUsers.columns``."""
+        # Flags take few distinct values, so count those instead of testing every user
+        flag_counts = Counter(flags)
+
+        def flagged(bit):
+            return sum(count for value, count in flag_counts.items() if value & bit)
+
+        self.totals = {
+            "total_users": len(user_ids),
+            "total_points": sum(points),
+            "banned_users": flagged(UserRecord.BANNED),
+            "blocked_users": flagged(UserRecord.BLOCKED),
+            "total_referrals": sum(referrals),
+            "referred_users": flagged(UserRecord.HAS_BEEN_REFERRED),
+            "rewards_claimed": sum(rewards_claimed),
+        }
+        if daily_claims is not None:
+            self.daily_claims = Counter(daily_claims)
+        else:
+            # No saved history: the best available is each user's latest claim.
+            self.daily_claims = Counter(last_claims)
+            del self.daily_claims[0]
+
+    def update(self, old, new):
+        old_values = _contribution(old) if old is not None else (0,) * len(STAT_TOTALS)
+        new_values = _contribution(new) if new is not None else (0,) * len(STAT_TOTALS)
+        for key, before, after in zip(STAT_TOTALS, old_values, new_values):
+            if before != after:
+                self.totals[key] += after - before
+
+        claim = new.last_daily_claim if new is not None else 0
+        if claim and (old is None or claim != old.last_daily_claim):
+            self.daily_claims[claim] += 1
+
+    def claims_between(self, first_day, last_day):
+        """Return [(date string, claims)] for every day from ``first_day`` to ``last_day`` inclusive."""
+        days = []
+        day = first_day
+        while day <= last_day:
+            days.append((str(day), self.daily_claims.get(to_day(day), 0)))
+            day += datetime.timedelta(days=1)
+        return days
+
+
+class ReferralGraph:
+    """Who referred whom, with the time of every referral, maintained incrementally.
+
+    ``children`` maps a referrer to the users they referred and ``_times`` holds
+    the matching referral times, both in time order, so a referrer's recent
+    referrals are a binary search away. A global timeline (parallel int arrays
+    sorted by time) answers "every referral since T" the same way. Every query
+    costs time proportional to its result, not to the number of users.
+    Referrals made before times were recorded have time 0 and are never
+    counted as recent.
+    """
+
+    def __init__(self):
+        self.children = {}
+        self._times = {}
+        self._timeline_times = array("q")
+        self._timeline_users = array("q")
+        self._timeline_referrers = array("q")
+
+    def build(self, user_ids, referrer_ids, referred_at):
+        """Index parallel columns, e.g. from ``SnapshotUsers.columns``; a referrer_id of None or 0 means none."""
+        edges = sorted(
+            (at, referrer_id, user_id)
+            for user_id, referrer_id, at in zip(user_ids, referrer_ids, referred_at)
+            if referrer_id
+        )
+        self.children = {}
+        self._times = {}
+        for at, referrer_id, user_id in edges:
+            self.children.setdefault(referrer_id, []).append(user_id)
+            self._times.setdefault(referrer_id, []).append(at)
+        self._timeline_times = array("q", (at for at, _, _ in edges))
+        self._timeline_referrers = array("q", (referrer_id for _, referrer_id, _ in edges))
+        self._timeline_users = array("q", (user_id for _, _, user_id in edges))
+
+    def add(self, referrer_id, user_id, at):
+        times = self._times.setdefault(referrer_id, [])
+        position = bisect_right(times, at)
+        times.insert(position, at)
+        self.children.setdefault(referrer_id, []).insert(position, user_id)
+
+        # Referrals normally arrive in time order, making this an append
+        position = bisect_right(self._timeline_times, at)
+        self._timeline_times.insert(position, at)
+        self._timeline_referrers.insert(position, referrer_id)
+        self._timeline_users.insert(position, user_id)
+
+    def downline(self, user_id, max_depth):
+        """Return [(user_id, depth)] for everyone below ``user_id``, breadth first, down to ``max_depth``."""
+        result = []
+        seen = {user_id}
+        level = [user_id]
+        for depth in range(1, max_depth + 1):
+            next_level = []
+            for parent in level:
+                for child in self.children.get(parent, ()):
+                    # Two users can refer each other, so the graph may have cycles
+                    if child not in seen:
+                        seen.add(child)
+                        next_level.append(child)
+                        result.append((child, depth))
+            if not next_level:
+                break
+            level = next_level
+        return result
+
+    def referrals_since(self, referrer_id, since):
+        times = self._times.get(referrer_id)
+        return len(times) - bisect_left(times, max(since, 1)) if times else 0
+
+    def recent(self, since):
+        """Return [(referred_at, referrer_id, user_id)] for every referral at or after ``since``, oldest first."""
+        start = bisect_left(self._timeline_times, max(since, 1))
+        return list(zip(
+            self._timeline_times[start:], self._timeline_referrers[start:], self._timeline_users[start:]
+        ))
+
+
+def find_bursts(referrals, window, threshold):
+    """Find referrers with at least ``threshold`` referrals inside any ``window`` seconds.
+
+    ``referrals`` is [(referred_at, referrer_id, user_id)] sorted by time, as
+    returned by ``ReferralGraph.recent``. Returns [(referrer_id, peak, total)],
+    where ``peak`` is the most referrals seen within one window, highest first.
+    """
+    times_by_referrer = {}
+    for at, referrer_id, _ in referrals:
+        times_by_referrer.setdefault(referrer_id, []).append(at)
+
+    bursts = []
+    for referrer_id, times in times_by_referrer.items():
+        if len(times) < threshold:
+            continue
+        peak = 0
+        start = 0
+        for end, at in enumerate(times):
+            while at - times[start] >= window:
+                start += 1
+            peak = max(peak, end - start + 1)
+        if peak >= threshold:
+            bursts.append((referrer_id, peak, len(times)))
+    bursts.sort(key=lambda burst: (-burst[1], burst[0]))
+    return bursts
@@ -0,0 +1,30 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class LockStripes:
+    """Fixed pool of asyncio locks shared by user ID hash.
+
+    Memory stays constant however many users there are; two users only
+    contend if they hash to the same stripe. Several keys are always locked in
+    stripe order, so two transactions over the same pair cannot deadlock.
+    """
+
+    def __init__(self, stripes=1024):
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+
+    def _indexes(self, keys):
+        return sorted({hash(key) % len(self._locks) for key in keys})
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        acquired = []
+        try:
+            for index in self._indexes(keys):
+                lock = self._locks[index]
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
@@ -0,0 +1,90 @@
+import asyncio
+import datetime
+import glob
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def rotate_backups(pattern, keep):
+    """Delete all but the newest ``keep`` files matching ``pattern``; returns how many were deleted."""
+    # Backup names end in a sortable timestamp, so name order is age order
+    backups = sorted(path for path in glob.glob(pattern) if not path.endswith(".tmp"))
+    stale = backups[:-keep] if keep > 0 else backups
+    for path in stale:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.error(f"Error removing old backup {path}: {str(e)}")
+    return len(stale)
+
+
+class Maintenance:
+    """Periodic upkeep scheduled on the application's JobQueue.
+
+    - ``backup``: a timestamped copy of the user store in ``backup_dir``,
+      keeping the newest ``backup_keep``;
+    - ``checkpoint``: ``store.checkpoint()``, which saves the journal store's
+      aggregates or truncates the SQLite WAL;
+    - ``prune``: drops expired entries from every object added with
+      ``add_cache`` (anything with a ``prune()`` method).
+
+    File work runs on worker threads. Pruning runs on the event loop because
+    the caches are not thread-safe; it only scans memory.
+    """
+
+    def __init__(self, store, backup_dir, backup_name, backup_interval=6 * 60 * 60, backup_keep=28,
+                 checkpoint_interval=5 * 60, prune_interval=5 * 60):
+        self.store = store
+        self.backup_dir = backup_dir
+        # "users.db" becomes backups named "users-20240131-235959.db"
+        self.backup_stem, self.backup_ext = os.path.splitext(backup_name)
+        self.backup_interval = backup_interval
+        self.backup_keep = backup_keep
+        self.checkpoint_interval = checkpoint_interval
+        self.prune_interval = prune_interval
+        self._caches = {}
+
+    def add_cache(self, name, cache):
+        self._caches[name] = cache
+
+    def schedule(self, job_queue, backups=True):
+        """Add the jobs to ``job_queue``; ``backups=False`` leaves backups to another process."""
+        if backups and self.backup_interval:
+            job_queue.run_repeating(self.backup, self.backup_interval, first=self.backup_interval, name="backup")
+        if self.checkpoint_interval:
+            job_queue.run_repeating(self.checkpoint, self.checkpoint_interval, name="checkpoint")
+        if self.prune_interval:
+            job_queue.run_repeating(self.prune, self.prune_interval, name="prune")
+
+    def backup_path(self, now=None):
+        stamp = (now or datetime.datetime.now()).strftime("%Y%m%d-%H%M%S")
+        return os.path.join(self.backup_dir, f"{self.backup_stem}-{stamp}{self.backup_ext}")
+
+    async def backup(self, context=None):
+        path = self.backup_path()
+        started = time.monotonic()
+        try:
+            os.makedirs(self.backup_dir, exist_ok=True)
+            await self.store.backup(path)
+            removed = await asyncio.get_running_loop().run_in_executor(
+                None, rotate_backups,
+                os.path.join(self.backup_dir, f"{self.backup_stem}-*{self.backup_ext}"), self.backup_keep
+            )
+        except Exception as e:
+            logger.error(f"Error writing backup {path}: {str(e)}")
+            return
+        logger.info(f"Wrote backup {path} in {time.monotonic() - started:.1f}s, removed {removed} old")
+
+    async def checkpoint(self, context=None):
+        try:
+            await self.store.checkpoint()
+        except Exception as e:
+            logger.error(f"Error checkpointing store: {str(e)}")
+
+    async def prune(self, context=None):
+        removed = {name: cache.prune() for name, cache in self._caches.items()}
+        if any(removed.values()):
+            logger.debug(f"Pruned expired entries: {removed}")
@@ -0,0 +1,275 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+from telegram.request import BaseRequest
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds; wide enough for both a dict lookup and a slow Bot API call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base for metrics with a fixed set of label names, rendered in the Prometheus text format.
+
+    Updates may come from worker threads (the journal flusher), so each
+    metric guards its values with a lock.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.extend(self._render_value(label_values, value))
+        return lines
+
+    def _render_value(self, label_values, value):
+        return [f"{self.name}{_labels(self.label_names, label_values)} {_number(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value read from ``callback`` whenever the metrics are scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, callback):
+        super().__init__(name, help)
+        self.callback = callback
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            lines.append(f"{self.name} {_number(self.callback())}")
+        except Exception as e:
+            logger.error(f"Error reading gauge {self.name}: {str(e)}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # Per-bucket (not cumulative) counts, then sum and count
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - started)
+
+    def _render_value(self, label_values, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += bucket_count
+            le = f'le="{bound}"'
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, label_values, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.label_names, label_values)} {_number(total)}")
+        lines.append(f"{self.name}_count{_labels(self.label_names, label_values)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """Add ``metric``; a gauge may be registered again to replace its callback."""
+        existing = self._metrics.get(metric.name)
+        if existing is not None and not (isinstance(existing, Gauge) and isinstance(metric, Gauge)):
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, callback):
+        return self.register(Gauge(name, help, callback))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    "bot_handler_seconds", "Time spent handling an update, by handler or text route", ["route"])
+HANDLER_ERRORS = REGISTRY.counter(
+    "bot_handler_errors_total", "Exceptions raised or errors logged while handling an update", ["route"])
+API_SECONDS = REGISTRY.histogram(
+    "bot_api_request_seconds", "Bot API request latency by method", ["method"])
+API_ERRORS = REGISTRY.counter(
+    "bot_api_errors_total", "Bot API requests that failed or returned an error status", ["method"])
+STORE_WRITE_SECONDS = REGISTRY.histogram(
+    "bot_store_write_seconds", "Time spent in user store writes by operation", ["operation"])
+REJECTED_UPDATES = REGISTRY.counter(
+    "bot_rejected_updates_total", "Updates dropped before any handler ran, by reason", ["reason"])
+
+# Route of the update being handled by the current task; errors logged inside it are charged to it
+current_route = contextvars.ContextVar("current_route", default=None)
+
+
+@contextmanager
+def track(route):
+    """Time a block as ``route`` and count an exception escaping it as an error."""
+    token = current_route.set(route)
+    try:
+        with HANDLER_SECONDS.time(route):
+            yield
+    except Exception:
+        HANDLER_ERRORS.inc(route)
+        raise
+    finally:
+        current_route.reset(token)
+
+
+def instrument(route, callback):
+    """Wrap a handler callback so every call is tracked as ``route``."""
+    @functools.wraps(callback)
+    async def tracked(update, context):
+        with track(route):
+            return await callback(update, context)
+    return tracked
+
+
+class ErrorLogCounter(logging.Handler):
+    """Counts ERROR log records against the route being handled.
+
+    Handlers catch their own exceptions and log them, so this is what turns
+    those into an error rate.
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record):
+        route = current_route.get()
+        if route is not None:
+            HANDLER_ERRORS.inc(route)
+
+
+def instrument_store(store, names=("put", "put_many", "flush")):
+    """Time the write methods of ``store`` that exist on it, labelled by method name."""
+    for name in names:
+        method = getattr(store, name, None)
+        if method is None:
+            continue
+        if asyncio.iscoroutinefunction(method):
+            async def timed(*args, _method=method, _name=name, **kwargs):
+                with STORE_WRITE_SECONDS.time(_name):
+                    return await _method(*args, **kwargs)
+        else:
+            def timed(*args, _method=method, _name=name, **kwargs):
+                with STORE_WRITE_SECONDS.time(_name):
+                    return _method(*args, **kwargs)
+        setattr(store, name, timed)
+
+
+class InstrumentedRequest(BaseRequest):
+    """Wraps another BaseRequest and records latency and failures per Bot API method."""
+
+    def __init__(self, request):
+        self.request = request
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await self.request.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        except Exception:
+            API_ERRORS.inc(api_method)
+            raise
+        finally:
+            API_SECONDS.observe(api_method, value=time.perf_counter() - started)
+        if status >= 400:
+            API_ERRORS.inc(api_method)
+        return status, payload
+
+
+async def start_metrics_server(host, port, registry=REGISTRY):
+    """Serve ``registry`` at http://host:port/metrics; returns the runner to clean up on shutdown."""
+
+    async def metrics(request):
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
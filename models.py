@@ -0,0 +1,202 @@
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Version of the on-disk user format written by the stores.
+# 1: users.json as a dict of free-form dicts keyed by user ID string (legacy)
+# 2: {"version": 2, "users": {user_id: UserRecord.to_list()}}
+SCHEMA_VERSION = 2
+
+EPOCH = datetime.date(1970, 1, 1)
+
+# Range of the integer columns of the snapshot (array "q") and of SQLite
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def to_day(date):
+    """Days since 1970-01-01 for a date (0 is used for "never")."""
+    return (date - EPOCH).days
+
+
+def from_day(day):
+    return EPOCH + datetime.timedelta(days=day)
+
+
+def today():
+    return to_day(datetime.date.today())
+
+
+def parse_day(value):
+    """Convert a legacy ISO date string (or an already converted int) to a day number."""
+    if isinstance(value, int):
+        return value
+    if not value:
+        return 0
+    try:
+        return to_day(datetime.date.fromisoformat(value))
+    except ValueError:
+        return 0
+
+
+def parse_user_id(value):
+    """Return ``value`` as an int user ID, or None if it is not one."""
+    if not isinstance(value, int):
+        value = str(value).strip()
+        # isdigit() alone also accepts characters like "²" that int() rejects
+        if not (value.isascii() and value.isdecimal()):
+            return None
+        value = int(value)
+    return value if 0 <= value <= INT64_MAX else None
+
+
+class UserRecord:
+    """One user's state: counters, dates as day numbers and boolean flags packed in one int.
+
+    ``tasks_done`` is a bitset of completed tasks, indexed by each task's
+    configured ``bit`` (see config.py).
+    """
+
+    __slots__ = (
+        "points", "referrals", "rewards_claimed", "referrer_id", "last_daily_claim", "flags", "email", "name",
+        "referred_at", "tasks_done",
+    )
+
+    AWAITING_EMAIL = 1 << 0
+    HAS_BEEN_REFERRED = 1 << 1
+    BANNED = 1 << 2
+    BLOCKED = 1 << 3
+    MIDAS_REFERRAL_CLICKED = 1 << 4
+    MIDAS_REFERRAL_COMPLETED = 1 << 5
+
+    # Task bit of the Midas task, which was tracked by the MIDAS_REFERRAL_* flags before tasks had bits
+    MIDAS_TASK_BIT = 0
+
+    # Legacy dict keys for each flag bit
+    FLAG_KEYS = {
+        "awaiting_email": AWAITING_EMAIL,
+        "has_been_referred": HAS_BEEN_REFERRED,
+        "banned": BANNED,
+        "blocked": BLOCKED,
+        "midas_referral_clicked": MIDAS_REFERRAL_CLICKED,
+        "midas_referral_completed": MIDAS_REFERRAL_COMPLETED,
+    }
+
+    def __init__(self, points=0, referrals=0, rewards_claimed=0, referrer_id=None,
+                 last_daily_claim=0, flags=0, email="", name="", referred_at=0, tasks_done=None):
+        self.points = points
+        self.referrals = referrals
+        self.rewards_claimed = rewards_claimed
+        self.referrer_id = referrer_id
+        self.last_daily_claim = last_daily_claim
+        self.flags = flags
+        self.email = email
+        self.name = name
+        # Unix time the referral was credited; 0 if never referred or referred before it was tracked
+        self.referred_at = referred_at
+        # None when read from a format that predates the field
+        self.tasks_done = self.legacy_tasks_done(flags) if tasks_done is None else tasks_done
+
+    @classmethod
+    def legacy_tasks_done(cls, flags):
+        """The tasks bitset implied by the flags of a record written before tasks had bits."""
+        return 1 << cls.MIDAS_TASK_BIT if flags & cls.MIDAS_REFERRAL_COMPLETED else 0
+
+    def has_completed(self, bit):
+        return bool(self.tasks_done >> bit & 1)
+
+    def mark_completed(self, bit):
+        self.tasks_done |= 1 << bit
+
+    def _get_flag(self, bit):
+        return bool(self.flags & bit)
+
+    def _set_flag(self, bit, value):
+        if value:
+            self.flags |= bit
+        else:
+            self.flags &= ~bit
+
+    def _flag(bit):
+        return property(lambda self: self._get_flag(bit), lambda self, value: self._set_flag(bit, value))
+
+    awaiting_email = _flag(AWAITING_EMAIL)
+    has_been_referred = _flag(HAS_BEEN_REFERRED)
+    banned = _flag(BANNED)
+    blocked = _flag(BLOCKED)
+    midas_referral_clicked = _flag(MIDAS_REFERRAL_CLICKED)
+    midas_referral_completed = _flag(MIDAS_REFERRAL_COMPLETED)
+    del _flag
+
+    def copy(self):
+        return UserRecord(*self.to_list())
+
+    def __eq__(self, other):
+        return isinstance(other, UserRecord) and self.to_list() == other.to_list()
+
+    def __repr__(self):
+        return f"UserRecord({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+    # Serialization
+
+    def to_list(self):
+        """Compact positional form used in snapshots and the journal; fields are only ever appended."""
+        return [self.points, self.referrals, self.rewards_claimed, self.referrer_id,
+                self.last_daily_claim, self.flags, self.email, self.name, self.referred_at, self.tasks_done]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*values)
+
+    @classmethod
+    def from_legacy(cls, data):
+        """Normalize a free-form users.json dict; missing keys get their defaults."""
+        flags = 0
+        for key, bit in cls.FLAG_KEYS.items():
+            if data.get(key):
+                flags |= bit
+        return cls(
+            points=int(data.get("points") or 0),
+            referrals=int(data.get("referrals") or 0),
+            rewards_claimed=int(data.get("rewards_claimed") or 0),
+            referrer_id=parse_user_id(data["referrer_id"]) if data.get("referrer_id") is not None else None,
+            last_daily_claim=parse_day(data.get("last_daily_claim")),
+            flags=flags,
+            email=data.get("email") or "",
+            name=data.get("name") or "",
+            referred_at=int(data.get("referred_at") or 0),
+        )
+
+    @classmethod
+    def load(cls, value):
+        """Build a record from either serialized form."""
+        return cls.from_list(value) if isinstance(value, list) else cls.from_legacy(value)
+
+
+def load_users(document):
+    """Return {int user_id: UserRecord} from a parsed users file of any schema version."""
+    if isinstance(document, dict) and "version" in document and "users" in document:
+        version = document["version"]
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"users file has schema version {version}, newer than {SCHEMA_VERSION}")
+        raw_users = document["users"]
+    else:
+        raw_users = document
+
+    users = {}
+    for key, value in raw_users.items():
+        user_id = parse_user_id(key)
+        if user_id is None:
+            logger.warning(f"Skipping user {key!r}: not a numeric user ID")
+            continue
+        users[user_id] = UserRecord.load(value)
+    return users
+
+
+def dump_users(users):
+    """Serialize {user_id: UserRecord} as the current schema version."""
+    return {
+        "version": SCHEMA_VERSION,
+        "users": {str(user_id): record.to_list() for user_id, record in users.items()},
+    }
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+def render_text(entries):
+    """Renderer for plain messages: one entry, sent as given."""
+    data = entries[0]["data"]
+    return {"text": data["text"], "parse_mode": data.get("parse_mode")}
+
+
+class Outbox:
+    """Background queue for notifications that are not the reply to the current update.
+
+    Handlers call ``enqueue`` and return; a pool of workers sends the messages
+    through the shared RateLimiter, retrying RetryAfter and network errors with
+    exponential backoff. Each message has a kind with a renderer that turns a
+    list of queued entries into one message; for kinds registered with
+    ``coalesce=True``, entries queued for the same chat while one is still
+    waiting are merged into that message ("5 new referrals" instead of five).
+
+    Entries are appended to a JSON-lines file at ``path`` when queued and
+    marked done once sent or dropped, so anything unsent when the process
+    stops is sent by the next one. Delivery is at least once: a message that
+    was in flight during a crash is sent again.
+    """
+
+    COALESCE_DELAY = 2.0
+    MAX_ATTEMPTS = 6
+    MAX_BACKOFF = 60.0
+    # Rewrite the file once it holds this many lines and is mostly finished entries
+    COMPACT_LINES = 10_000
+
+    def __init__(self, path, limiter, workers=4):
+        self.path = path
+        self.limiter = limiter
+        self.workers = workers
+        self._renderers = {"text": render_text}
+        self._coalesced = set()
+        # (chat_id, kind) for coalesced kinds, else (chat_id, kind, entry id) -> [entry, ...]
+        self._pending = {}
+        # First entry id -> group taken by a worker and not yet marked done
+        self._sending = {}
+        self._queue = None
+        self._tasks = []
+        self._bot = None
+        self._file = None
+        self._lines = 0
+        self._next_id = 1
+
+    def register(self, kind, render, coalesce=False):
+        """Add a message kind; ``render(entries)`` returns send_message keyword arguments."""
+        self._renderers[kind] = render
+        if coalesce:
+            self._coalesced.add(kind)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._pending.values())
+
+    def _live_entries(self):
+        return [entry for groups in (self._sending, self._pending) for group in groups.values() for entry in group]
+
+    # Persistence
+
+    def _load(self):
+        """Return the entries of ``path`` that were queued but never marked done."""
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # Torn last line from a crash mid-write
+                    logger.warning(f"Skipping unreadable line in {self.path}")
+                    continue
+                if "done" in item:
+                    for entry_id in item["done"]:
+                        entries.pop(entry_id, None)
+                else:
+                    entries[item["id"]] = item
+        return entries
+
+    def _rewrite(self, entries):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._lines = len(entries)
+
+    def _append(self, item):
+        self._file.write(json.dumps(item) + "\n")
+        self._file.flush()
+        self._lines += 1
+
+    def _mark_done(self, entries):
+        self._append({"done": [entry["id"] for entry in entries]})
+        if self._lines >= self.COMPACT_LINES:
+            live = self._live_entries()
+            if len(live) * 4 < self._lines:
+                self._rewrite(live)
+
+    # Lifecycle
+
+    def start(self, bot):
+        """Reload unsent entries and start sending with ``bot``; call from inside the running event loop."""
+        self._bot = bot
+        entries = self._load()
+        self._pending = {}
+        self._sending = {}
+        self._queue = asyncio.PriorityQueue()
+        self._rewrite(list(entries.values()))
+        for entry in entries.values():
+            self._next_id = max(self._next_id, entry["id"] + 1)
+            self._add(entry, delay=0)
+        if entries:
+            logger.info(f"Resuming {len(entries)} unsent notifications")
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop the workers; entries not yet sent stay in the file for the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # Queueing
+
+    def enqueue(self, chat_id, text=None, kind="text", parse_mode=None, **data):
+        """Queue a message for ``chat_id``; returns immediately."""
+        if kind not in self._renderers:
+            raise ValueError(f"unknown outbox message kind {kind!r}")
+        if text is not None:
+            data["text"] = text
+        if parse_mode is not None:
+            data["parse_mode"] = parse_mode
+        entry = {"id": self._next_id, "chat_id": chat_id, "kind": kind, "data": data}
+        self._next_id += 1
+        self._append(entry)
+        self._add(entry, delay=self.COALESCE_DELAY if kind in self._coalesced else 0)
+
+    def _add(self, entry, delay):
+        if entry["kind"] in self._coalesced:
+            key = (entry["chat_id"], entry["kind"])
+        else:
+            key = (entry["chat_id"], entry["kind"], entry["id"])
+        group = self._pending.get(key)
+        if group is not None:
+            group.append(entry)
+            return
+        self._pending[key] = [entry]
+        self._queue.put_nowait((time.monotonic() + delay, entry["id"], key))
+
+    # Sending
+
+    async def _work(self):
+        while True:
+            ready_at, _, key = await self._queue.get()
+            delay = ready_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # Later entries for the same chat and kind join until the group is taken here
+            entries = self._pending.pop(key)
+            self._sending[entries[0]["id"]] = entries
+            try:
+                await self._deliver(key[0], entries)
+            except Exception as e:
+                logger.error(f"Dropping notification to {key[0]}: {str(e)}")
+            del self._sending[entries[0]["id"]]
+            self._mark_done(entries)
+
+    async def _deliver(self, chat_id, entries):
+        message = self._renderers[entries[0]["kind"]](entries)
+        for attempt in range(self.MAX_ATTEMPTS):
+            await self.limiter.acquire(chat_id)
+            try:
+                await self._bot.send_message(chat_id=chat_id, **message)
+                return
+            except RetryAfter as e:
+                self.limiter.pause(e.retry_after)
+            except (Forbidden, BadRequest) as e:
+                logger.info(f"Dropping notification to {chat_id}: {str(e)}")
+                return
+            except TelegramError as e:
+                logger.warning(f"Failed to send notification to {chat_id}: {str(e)}")
+                await asyncio.sleep(min(2 ** attempt, self.MAX_BACKOFF))
+        logger.error(f"Giving up on notification to {chat_id} after {self.MAX_ATTEMPTS} attempts")
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+
+from aiohttp import web
+from telegram import Update
+from telegram.error import RetryAfter, TelegramError
+
+from webhook import make_webhook_app
+
+logger = logging.getLogger(__name__)
+
+# Sharded mode: one front process receives updates (polling or webhook) and
+# forwards each one, as a JSON line on stdin, to the worker process that owns
+# its user. Every update of a user goes to the same worker, so per-user state
+# and in-process caches stay local to one process; the workers share one
+# SQLite database in WAL mode, which serializes writes that cross shards
+# (the referrer credit in /start) with its database write lock.
+
+
+def shard_for(user_id, shards):
+    """Index of the shard that owns ``user_id``."""
+    return user_id % shards
+
+
+def update_owner(update):
+    """The user ID an update is routed by: its sender, else its chat, else 0."""
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return abs(update.effective_chat.id)
+    return 0
+
+
+class ShardSupervisor:
+    """Starts the worker processes and hands each update to the one that owns it."""
+
+    def __init__(self, shards, command, env=None):
+        self.shards = shards
+        self.command = command
+        self.env = env or os.environ
+        self._processes = []
+
+    async def start(self):
+        for index in range(self.shards):
+            env = dict(self.env, SHARD_INDEX=str(index), SHARD_COUNT=str(self.shards))
+            process = await asyncio.create_subprocess_exec(*self.command, stdin=asyncio.subprocess.PIPE, env=env)
+            self._processes.append(process)
+            logger.info(f"Started shard {index} (pid {process.pid})")
+
+    async def dispatch(self, update):
+        process = self._processes[shard_for(update_owner(update), self.shards)]
+        if process.returncode is not None:
+            raise RuntimeError(f"shard process {process.pid} exited with {process.returncode}")
+        process.stdin.write(json.dumps(update.to_dict(), separators=(",", ":")).encode() + b"\n")
+        # Backpressure: a shard that falls behind slows intake instead of buffering without limit
+        await process.stdin.drain()
+
+    async def stop(self):
+        """Close every worker's input and wait for it to finish the updates it already has."""
+        for process in self._processes:
+            if process.returncode is None:
+                process.stdin.close()
+        for process in self._processes:
+            await process.wait()
+        self._processes = []
+
+
+async def serve_shard(application, stream=None):
+    """Worker side: feed updates read from ``stream`` (default stdin) into ``application`` until EOF."""
+    stream = stream or sys.stdin.buffer
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=2 ** 22)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stream)
+    # Ctrl+C reaches the whole process group; the front process decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            update = Update.de_json(json.loads(line), application.bot)
+            if update is not None:
+                await application.update_queue.put(update)
+    finally:
+        # Application.stop() waits for the updates still queued to be handled
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def _wait_for_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await stop.wait()
+
+
+async def _poll(bot, supervisor, position, timeout=30):
+    """Long-poll getUpdates forever; ``position["offset"]`` is the next update to fetch."""
+    backoff = 1
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=position["offset"], timeout=timeout, allowed_updates=Update.ALL_TYPES
+            )
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        except TelegramError as e:
+            logger.error(f"Error fetching updates: {str(e)}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+            continue
+        backoff = 1
+        for update in updates:
+            await supervisor.dispatch(update)
+            position["offset"] = update.update_id + 1
+
+
+async def run_sharded(bot, supervisor, webhook=None):
+    """Run the front process until SIGINT/SIGTERM.
+
+    ``webhook`` is None for long polling, else a dict with the listen,
+    port, path, secret_token, webhook_url and max_connections settings of
+    ``webhook.run_webhook``.
+    """
+    await bot.initialize()
+    await supervisor.start()
+    runner = None
+    receiver = None
+    position = {"offset": None}
+    try:
+        if webhook is None:
+            await bot.delete_webhook()
+            receiver = asyncio.create_task(_poll(bot, supervisor, position))
+        else:
+            runner = web.AppRunner(make_webhook_app(bot, supervisor.dispatch, webhook["path"], webhook["secret_token"]))
+            await runner.setup()
+            await web.TCPSite(runner, webhook["listen"], webhook["port"]).start()
+            if webhook["webhook_url"]:
+                await bot.set_webhook(
+                    url=f"{webhook['webhook_url'].rstrip('/')}{webhook['path']}",
+                    secret_token=webhook["secret_token"],
+                    max_connections=webhook["max_connections"],
+                    allowed_updates=Update.ALL_TYPES,
+                )
+            logger.info(f"Webhook server listening on {webhook['listen']}:{webhook['port']}{webhook['path']}")
+
+        stopped = asyncio.create_task(_wait_for_signal())
+        waiting = [stopped] if receiver is None else [stopped, receiver]
+        done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+        if receiver is not None and receiver in done:
+            # Polling only ends by raising, e.g. a shard that died
+            receiver.result()
+    finally:
+        logger.info(f"Stopping {supervisor.shards} shards...")
+        if receiver is not None:
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+            if position["offset"] is not None:
+                # Confirm the updates already dispatched so they are not fetched again after a restart
+                try:
+                    await bot.get_updates(offset=position["offset"], timeout=0, limit=1)
+                except TelegramError as e:
+                    logger.error(f"Could not confirm the last updates: {str(e)}")
+        if runner is not None:
+            await runner.cleanup()
+        await supervisor.stop()
+        await bot.shutdown()
@@ -0,0 +1,241 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import compress
+
+from models import UserRecord
+
+# Binary snapshot layout (all integers little-endian int64, rows sorted by user_id):
+#
+#   header   MAGIC, format version (u32), row count (u64), string bytes (u64), reserved (u64)
+#   columns  one array of ``count`` values per entry of INT_COLUMNS
+#   strings  ``count + 1`` offsets per entry of STR_COLUMNS, then one UTF-8 blob
+#
+# A referrer_id of 0 means "no referrer". Fixed-width columns let a reader
+# find a user by binary search over the mmap'd user_id column and decode only
+# that row, so mapping a snapshot costs the same for 1k or 1M users. Opening a
+# JournalStore still grows with the user count: it builds its indexes from
+# whole columns, O(n) but without decoding any record.
+MAGIC = b"USRB"
+FORMAT_VERSION = 3
+HEADER = struct.Struct("<4sIQQQ")
+INT_COLUMNS = (
+    "user_id", "points", "referrals", "rewards_claimed", "referrer_id", "last_daily_claim", "flags",
+    "referred_at", "tasks_done",
+)
+# Columns present in each format version; newer columns read as 0 from older files,
+# except tasks_done, which is derived from the flags
+VERSION_COLUMNS = {1: INT_COLUMNS[:7], 2: INT_COLUMNS[:8], 3: INT_COLUMNS}
+STR_COLUMNS = ("email", "name")
+
+
+def is_binary_snapshot(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def write_snapshot(f, items):
+    """Write (user_id, UserRecord) pairs, in any order, to the binary file object ``f``."""
+    items = sorted(items, key=lambda item: item[0])
+    ints = {column: array("q") for column in INT_COLUMNS}
+    offsets = {column: array("q", [0]) for column in STR_COLUMNS}
+    blobs = {column: bytearray() for column in STR_COLUMNS}
+    for user_id, record in items:
+        ints["user_id"].append(user_id)
+        ints["points"].append(record.points)
+        ints["referrals"].append(record.referrals)
+        ints["rewards_claimed"].append(record.rewards_claimed)
+        ints["referrer_id"].append(record.referrer_id or 0)
+        ints["last_daily_claim"].append(record.last_daily_claim)
+        ints["flags"].append(record.flags)
+        ints["referred_at"].append(record.referred_at)
+        ints["tasks_done"].append(record.tasks_done)
+        for column in STR_COLUMNS:
+            blobs[column] += getattr(record, column).encode()
+            offsets[column].append(len(blobs[column]))
+
+    # Offsets point into the concatenation of the per-column blobs
+    start = 0
+    for column in STR_COLUMNS:
+        if start:
+            offsets[column] = array("q", (offset + start for offset in offsets[column]))
+        start += len(blobs[column])
+    blob = b"".join(blobs.values())
+
+    f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(items), len(blob), 0))
+    for values in (*ints.values(), *offsets.values()):
+        if sys.byteorder != "little":
+            values.byteswap()
+        f.write(values.tobytes())
+    f.write(blob)
+
+
+class SnapshotUsers:
+    """Mapping of user_id to UserRecord over a memory-mapped binary snapshot.
+
+    Rows are decoded on first access and kept, together with every record
+    written since the snapshot was opened, in a small dict that takes
+    precedence over the mapped file. ``columns`` reads columns straight from
+    the mapping, which is how the store builds its indexes without decoding
+    any record.
+    """
+
+    def __init__(self, path=None):
+        self._mmap = None
+        self._view = None
+        self._columns = {column: array("q") for column in INT_COLUMNS}
+        self._offsets = {column: () for column in STR_COLUMNS}
+        self._strings = b""
+        self._base_count = 0
+        self._records = {}
+        self._deleted = set()
+        self._length = 0
+        if path is not None:
+            self._map(path)
+
+    @classmethod
+    def from_records(cls, records):
+        users = cls()
+        users._records = dict(records)
+        users._length = len(records)
+        return users
+
+    def _map(self, path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise ValueError(f"{path} is too short to be a snapshot")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, string_bytes, _ = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version not in VERSION_COLUMNS:
+            raise ValueError(f"{path} is not a snapshot this version can read")
+        if sys.byteorder != "little":
+            raise ValueError("binary snapshots can only be mapped on little-endian hosts")
+
+        view = self._view = memoryview(self._mmap)
+        position = HEADER.size
+        for column in INT_COLUMNS:
+            if column not in VERSION_COLUMNS[version]:
+                self._columns[column] = array("q", bytes(count * 8))
+                continue
+            self._columns[column] = view[position:position + count * 8].cast("q")
+            position += count * 8
+        if "tasks_done" not in VERSION_COLUMNS[version]:
+            self._columns["tasks_done"] = array("q", map(UserRecord.legacy_tasks_done, self._columns["flags"]))
+        for column in STR_COLUMNS:
+            self._offsets[column] = view[position:position + (count + 1) * 8].cast("q")
+            position += (count + 1) * 8
+        self._strings = view[position:position + string_bytes]
+        self._base_count = self._length = count
+
+    def close(self):
+        if self._mmap is None:
+            return
+        for view in (*self._columns.values(), *self._offsets.values(), self._strings, self._view):
+            if isinstance(view, memoryview):
+                view.release()
+        self._mmap.close()
+        self._mmap = None
+        self.__init__()
+
+    # Base rows
+
+    def _row(self, user_id):
+        ids = self._columns["user_id"]
+        row = bisect_left(ids, user_id)
+        return row if row < self._base_count and ids[row] == user_id else None
+
+    def _string(self, column, row):
+        offsets = self._offsets[column]
+        return str(self._strings[offsets[row]:offsets[row + 1]], "utf-8")
+
+    def _decode(self, row):
+        columns = self._columns
+        return UserRecord(
+            columns["points"][row],
+            columns["referrals"][row],
+            columns["rewards_claimed"][row],
+            columns["referrer_id"][row] or None,
+            columns["last_daily_claim"][row],
+            columns["flags"][row],
+            self._string("email", row),
+            self._string("name", row),
+            columns["referred_at"][row],
+            columns["tasks_done"][row],
+        )
+
+    # Mapping interface
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id):
+        record = self.get(user_id)
+        if record is None:
+            raise KeyError(user_id)
+        return record
+
+    def get(self, user_id, default=None):
+        record = self._records.get(user_id)
+        if record is not None:
+            return record
+        if user_id in self._deleted:
+            return default
+        row = self._row(user_id)
+        if row is None:
+            return default
+        record = self._records[user_id] = self._decode(row)
+        return record
+
+    def __setitem__(self, user_id, record):
+        if user_id not in self:
+            self._length += 1
+        self._deleted.discard(user_id)
+        self._records[user_id] = record
+
+    def pop(self, user_id, default=None):
+        record = self.get(user_id)
+        if record is None:
+            return default
+        del self._records[user_id]
+        if self._row(user_id) is not None:
+            self._deleted.add(user_id)
+        self._length -= 1
+        return record
+
+    def keys(self):
+        return self.columns()[0]
+
+    def items(self):
+        """Yield every (user_id, record); safe to call while another thread writes.
+
+        Rows that have not been read yet are decoded on the fly without being kept.
+        """
+        records = dict(self._records)
+        skip = records.keys() | self._deleted
+        for row, user_id in enumerate(self._columns["user_id"]):
+            if user_id not in skip:
+                yield user_id, self._decode(row)
+        yield from records.items()
+
+    def columns(self, *names):
+        """Return ([user_id, ...], *[value, ...] per name) over every user, read from the int columns."""
+        records = dict(self._records)
+        skip = records.keys() | self._deleted
+        columns = [self._columns["user_id"].tolist(), *(self._columns[name].tolist() for name in names)]
+        if skip:
+            # Rows that were decoded, replaced or deleted come from ``records`` instead
+            keep = [user_id not in skip for user_id in columns[0]]
+            columns = [list(compress(column, keep)) for column in columns]
+        columns[0].extend(records)
+        for column, name in zip(columns[1:], names):
+            column.extend(getattr(record, name) for record in records.values())
+        return columns
@@ -0,0 +1,58 @@
+import re
+
+from models import UserRecord
+
+
+def compile_link_matcher(tasks):
+    """One regex for the patterns of the link tasks in ``tasks``, or None if there are none.
+
+    The pattern of ``tasks[i]`` is wrapped in the named group ``task{i}``.
+    Raises ValueError if the patterns cannot be combined, e.g. because one
+    starts with a global flag such as (?i) rather than a scoped (?i:...).
+    """
+    alternatives = [f"(?P<task{i}>{task.pattern})" for i, task in enumerate(tasks) if task.verify == "link"]
+    if not alternatives:
+        return None
+    try:
+        return re.compile("|".join(alternatives))
+    except re.error as e:
+        raise ValueError(f"task patterns cannot be combined into one regex: {e}")
+
+
+class TaskRegistry:
+    """The configured tasks, indexed for the lookups made while handling messages.
+
+    Menu buttons and IDs are dict lookups. The patterns of every link task
+    are combined into one regex, so telling whether a message is a task link
+    is one search however many tasks there are; the name of the matching
+    group identifies the task.
+    """
+
+    def __init__(self, tasks):
+        self.tasks = tuple(tasks)
+        self.by_id = {task.id: task for task in self.tasks}
+        self.by_button = {task.button: task for task in self.tasks}
+        self._link_tasks = {f"task{i}": task for i, task in enumerate(self.tasks) if task.verify == "link"}
+        self._link_matcher = compile_link_matcher(self.tasks)
+
+    def match_link(self, text):
+        """The link task whose pattern ``text`` contains, or None."""
+        if self._link_matcher is None:
+            return None
+        match = self._link_matcher.search(text)
+        return self._link_tasks[match.lastgroup] if match else None
+
+
+async def complete_task(store, user_id, task):
+    """Award ``task`` to ``user_id`` unless already done; returns (awarded, record).
+
+    The completion bit is tested and set in the same transaction as the
+    award, so a repeated or concurrent completion can never pay twice.
+    """
+    async with store.transaction(user_id) as tx:
+        user = tx.get(user_id) or tx.create(user_id, UserRecord())
+        if user.has_completed(task.bit):
+            return False, user
+        user.mark_completed(task.bit)
+        user.points += task.points
+    return True, user
@@ -0,0 +1,35 @@
+import time
+
+from caches import TTLCache
+
+
+class UserThrottle:
+    """Token bucket per user: up to ``burst`` updates at once, refilled at ``rate`` per second.
+
+    Over any window of t seconds a user gets at most ``burst + rate * t``
+    updates through. A bucket left idle for ``burst / rate`` seconds is full
+    again, the same as a new one, so buckets live in a TTLCache with that
+    TTL and memory only holds recently active users.
+    """
+
+    def __init__(self, rate=1.0, burst=10, maxsize=100_000):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = TTLCache(maxsize=maxsize, ttl=burst / rate)
+
+    def allow(self, user_id):
+        """Take a token for ``user_id``; False if the bucket is empty."""
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens, updated = bucket
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self._buckets.set(user_id, (tokens - 1 if allowed else tokens, now))
+        return allowed
+
+    def prune(self):
+        """Drop the buckets that have refilled completely; returns how many."""
+        return self._buckets.prune()
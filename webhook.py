@@ -0,0 +1,95 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def make_webhook_app(bot, put_update, path, secret_token):
+    """Build the aiohttp app that passes POSTed updates to ``await put_update(update)``.
+
+    Requests without the expected secret token header are rejected, so only
+    Telegram (or a local test that knows the secret) can inject updates.
+    """
+
+    async def receive_update(request):
+        if secret_token and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret_token):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        try:
+            update = Update.de_json(data, bot)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            # Valid JSON that is not the shape of an Update
+            logger.warning(f"Rejected malformed update: {str(e)}")
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+        await put_update(update)
+        return web.Response()
+
+    async def health(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    app.router.add_get("/healthz", health)
+    return app
+
+
+async def run_webhook(application, listen, port, path, secret_token, webhook_url=None, max_connections=40):
+    """Run ``application`` behind an embedded HTTP server until SIGINT/SIGTERM.
+
+    If ``webhook_url`` is given, the webhook is registered with Telegram;
+    otherwise the server only listens locally, which is enough to test by
+    POSTing Update JSON to it.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+
+    runner = web.AppRunner(make_webhook_app(application.bot, application.update_queue.put, path, secret_token))
+    try:
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=f"{webhook_url.rstrip('/')}{path}",
+                secret_token=secret_token,
+                max_connections=max_connections,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        await application.start()
+
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+        logger.info(f"Webhook server listening on {listen}:{port}{path}")
+
+        await stop.wait()
+    finally:
+        logger.info("Shutting down webhook server...")
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)